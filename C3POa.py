@@ -7,29 +7,42 @@ import numpy as np
 import argparse
 import multiprocessing as mp
 import mappy as mm
-from conk import conk
 from tqdm import tqdm
 import gc
-import gzip
 import shutil
+import resource
+import threading
+import io
+from multiprocessing.pool import ThreadPool
 from glob import glob
 
 PATH = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/bin/'
 sys.path.append(os.path.abspath(PATH))
 
 from preprocess import preprocess
-from call_peaks import call_peaks
-from determine_consensus import determine_consensus
+from call_peaks import read_peaks, split_read, subread_bounds
+from coarse_peaks import coarse_read_peaks
+from determine_consensus import determine_consensus, make_scratch, remove_scratch, racon_file_ops, RACON_FILE_OPS
+from qc_stats import new_stats, count, add_read, merge_stats, write_stats
+from results_table import write_rows, merge_tables
+from result_cache import ResultCache, digest
+from sweep import parse_grid, new_summary, merge_summary, sweep_reads, write_summary
+from autotune import autotune, report, MAXRSS_UNIT
+from read_input import resolve_inputs, iter_reads
+from profiler import profiled, merge_profiles, report_profile
+from concat import merge_files, add_merge, report_merge
+from read_batch import BatchPool
 
 VERSION = 'v2.2.3'
 
-def parse_args():
-    '''Parses arguments.'''
+def build_parser():
+    '''Command line options, also the option defaults of the library API'''
     parser = argparse.ArgumentParser(description='Makes consensus sequences from R2C2 reads.',
                                      add_help=True,
                                      prefix_chars='-')
-    parser.add_argument('--reads', '-r', type=str, action='store',
-                          help='FASTQ file that contains the long R2C2 reads.')
+    parser.add_argument('--reads', '-r', type=str, action='store', nargs='+',
+                          help='''FASTQ files that contain the long R2C2 reads. Takes several
+                                  files, globs or directories, gzipped or not.''')
     parser.add_argument('--splint_file', '-s', type=str, action='store',
                           help='Path to the splint FASTA file.')
     parser.add_argument('--out_path', '-o', type=str, action='store', default=os.getcwd(),
@@ -39,12 +52,19 @@ def parse_args():
                         help='''If you want to use a config file to specify paths to
                                 programs, specify them here. Use for racon and blat
                                 if they are not in your path.''')
+    parser.add_argument('--qualcutoff', '-q', type=float, action='store', default=0,
+                        help='''Sets the average quality cutoff for your raw sequences. Anything
+                                below the cutoff will be excluded. Defaults to 0 (keeps all reads).''')
     parser.add_argument('--lencutoff', '-l', type=int, action='store', default=1000,
                         help='''Sets the length cutoff for your raw sequences. Anything
                                 shorter than the cutoff will be excluded. Defaults to 1000.''')
     parser.add_argument('--mdistcutoff', '-d', type=int, action='store', default=500,
                         help='''Sets the median distance cutoff for consensus sequences.
                                 Anything shorter will be excluded. Defaults to 500.''')
+    parser.add_argument('--coarse_scoring', type=int, default=0,
+                        help='''Reads at least this long are scored for splints only in windows
+                                around k-mer matches to the splint instead of along the whole
+                                read, for ultra-long reads. Defaults to 0 (off).''')
     parser.add_argument('--zero', '-z', action='store_false', default=True,
                         help='Use to exclude zero repeat reads. Defaults to True (includes zero repeats).')
     parser.add_argument('--numThreads', '-n', type=int, default=1,
@@ -53,10 +73,117 @@ def parse_args():
                         help='Number of reads processed by each thread in each iteration. Defaults to 1000.')
     parser.add_argument('--blatThreads', '-b', action='store_true', default=False,
                         help='''Use to chunk blat across the number of threads instead of by groupSize (faster).''')
+    parser.add_argument('--readerProcs', type=int, default=2,
+                        help='''Number of processes decompressing and parsing input files when
+                                there are several. Each sends its reads in chunks and stays a
+                                few chunks ahead of the consensus calls. Defaults to 2.''')
+    parser.add_argument('--blatProcs', type=int, default=0,
+                        help='Number of blat processes. Defaults to --numThreads.')
+    parser.add_argument('--readThreads', type=int, default=1,
+                        help='''Threads per consensus process that call reads of its group
+                                concurrently, overlapping abPOA, mappy and racon waits while
+                                sharing one interpreter's memory. Defaults to 1.''')
+    parser.add_argument('--inFlight', type=int, default=0,
+                        help='''Maximum number of groups waiting for or in the consensus pool.
+                                Bounds the reads held in memory. Defaults to 0 (no limit).''')
+    parser.add_argument('--read_batches', type=str, action='store', default='pickle',
+                        choices=['pickle', 'shared_memory'],
+                        help='''How groups of reads get to the workers. "pickle" sends a pickled
+                                copy of every group, "shared_memory" packs them into shared memory
+                                blocks that are reused between groups. Defaults to pickle.''')
+    parser.add_argument('--autotune', action='store_true', default=False,
+                        help='''Calibrate on a sample of reads and pick --numThreads, --groupSize,
+                                --blatProcs and --inFlight for the available cores and
+                                --max_memory. Prints a projected runtime.''')
+    parser.add_argument('--autotune_reads', type=int, default=200,
+                        help='Number of reads to calibrate on with --autotune. Defaults to 200.')
+    parser.add_argument('--max_memory', type=int, default=0,
+                        help='''Memory budget in MB for --autotune. Defaults to 0
+                                (the memory available when C3POa starts).''')
+    parser.add_argument('--polish', '-p', type=str, action='store', default='always',
+                        choices=['always', 'adaptive', 'never'],
+                        help='''Racon polishing policy. "always" polishes every consensus,
+                                "never" keeps the abPOA consensus and "adaptive" skips racon
+                                for reads that meet --polish_repeats, --polish_qual or
+                                --polish_agreement. Defaults to always.''')
+    parser.add_argument('--polish_repeats', type=int, default=5,
+                        help='''Adaptive polishing: reads with at least this many repeats
+                                are not polished. Defaults to 5.''')
+    parser.add_argument('--polish_qual', type=float, default=0,
+                        help='''Adaptive polishing: reads whose subreads have at least this
+                                average quality are not polished. Defaults to 0 (off).''')
+    parser.add_argument('--polish_agreement', type=float, default=0,
+                        help='''Adaptive polishing: reads whose abPOA MSA has at least this
+                                fraction of fully agreeing columns are not polished.
+                                Defaults to 0 (off).''')
+    parser.add_argument('--max_subreads', type=int, default=0,
+                        help='''Subread budget: only the N best subreads of a read (by mean
+                                quality and length agreement with the median subread) go into
+                                abPOA. Defaults to 0 (all subreads).''')
+    parser.add_argument('--extra_subreads', type=str, action='store', default='polish',
+                        choices=['polish', 'drop'],
+                        help='''What happens to subreads over --max_subreads: "polish" still
+                                gives them to racon, "drop" leaves them out of the consensus.
+                                Defaults to polish.''')
+    parser.add_argument('--racon_overlaps', type=str, action='store', default='mappy',
+                        choices=['mappy', 'msa'],
+                        help='''How the subread to consensus overlaps racon needs are made. "mappy"
+                                maps every subread to an index of the consensus, "msa" reads them
+                                off the abPOA MSA (3 or more subreads) and places dangling ends by
+                                their position in the read, mapping only what is left.
+                                Defaults to mappy.''')
+    parser.add_argument('--guard_length', type=int, default=0,
+                        help='''Reads longer than this are not called with their group but get
+                                the --guard_action. Defaults to 0 (off).''')
+    parser.add_argument('--guard_peaks', type=int, default=0,
+                        help='''Reads with more splint peaks than this are not called with their
+                                group but get the --guard_action. Defaults to 0 (off).''')
+    parser.add_argument('--guard_subreads', type=int, default=0,
+                        help='''Reads with more subreads than this only get an abPOA consensus
+                                of their best this many subreads (ranked like --max_subreads)
+                                and no racon. Defaults to 0 (off).''')
+    parser.add_argument('--guard_timeout', type=float, default=0,
+                        help='''Seconds racon may polish one read before it is stopped and the
+                                read keeps its abPOA consensus. Defaults to 0 (no limit).''')
+    parser.add_argument('--guard_action', type=str, action='store', default='slow_lane',
+                        choices=['slow_lane', 'skip'],
+                        help='''What happens to reads over --guard_length or --guard_peaks.
+                                "slow_lane" calls them after all groups, one read per task,
+                                "skip" leaves them out. Defaults to slow_lane.''')
+    parser.add_argument('--scratch', type=str, action='store', default='',
+                        help='''Directory for the per-read racon files, e.g. /dev/shm or a
+                                node-local disk. Each worker gets its own reused set of files
+                                there. Defaults to a tmp directory in --out_path.''')
+    parser.add_argument('--cache', type=str, action='store', default='',
+                        help='''Directory of a per-read result cache (splint assignment, peaks,
+                                abPOA and racon consensus). Re-runs only recompute stages whose
+                                read or parameters changed. Off by default.''')
+    parser.add_argument('--cache_size', type=int, default=10000,
+                        help='''Maximum size of the result cache in MB. Least recently used
+                                results are evicted at the end of a run. Defaults to 10000.''')
+    parser.add_argument('--sweep', type=str, action='store', default='',
+                        help='''Parameter sweep instead of consensus calling, e.g.
+                                "mdistcutoff=300,500;window=31,41;tolerance=0.2,0.3".
+                                Sweepable: penalty, iters, window, order, mdistcutoff and
+                                tolerance (subread length filter). Writes c3poa_sweep.tsv.''')
+    parser.add_argument('--subread_output', type=str, action='store', default='fastq',
+                        choices=['fastq', 'coords'],
+                        help='''Subread output format. "fastq" writes R2C2_Subreads.fastq, "coords"
+                                only the read name, subread index and [start, end) of every
+                                subread to R2C2_Subreads.tsv. materialize_subreads.py turns it
+                                into the fastq from the input reads. Defaults to fastq.''')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='''Sample the stacks of every blat and consensus worker and merge them
+                                into c3poa_profile.folded (collapsed stacks for flame graphs).
+                                Time spent waiting on blat and racon has its own root.''')
     parser.add_argument('--compress_output', '-co', action='store_true', default=False,
                         help='Use to compress (gzip) both the consensus fasta and subread fastq output files.')
     parser.add_argument('--version', '-v', action='version', version=VERSION, help='Prints the C3POa version.')
+    return parser
 
+def parse_args():
+    '''Parses arguments.'''
+    parser = build_parser()
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(0)
@@ -85,92 +212,193 @@ def configReader(path, configIn):
 
 def cat_files(path, pattern, output, description, compress):
     '''Use glob to get around bash argument list limitations'''
-    if compress:
-        output += '.gz'
-        final_fh = gzip.open(output, 'wb+')
-    else:
-        final_fh = open(output, 'w+')
-    for f in tqdm(glob(path + pattern), desc=description):
-        with open(f) as fh:
-            for line in fh:
-                if compress:
-                    line = line.encode()
-                final_fh.write(line)
-    final_fh.close()
+    return merge_files(sorted(glob(path + pattern)), output, compress, description)
 
 def remove_files(path, pattern):
     '''Use glob to get around bash argument list limitations'''
     for d in tqdm(glob(path + pattern), desc='Removing files'):
         shutil.rmtree(d)
 
-def rounding(x, base):
-    '''Rounds to the nearest base, we use 50'''  #round to nearest 50, e.g. 0, 50, 100, 150, etc (e.g. 59 becomes 50)
-    return int(base * round(float(x) / base))
+def average_quality(qual):
+    '''Mean phred quality of a quality string'''
+    return float(np.frombuffer(qual.encode(), dtype=np.uint8).mean()) - 33
 
-def analyze_reads(args, reads, splint_dict, adapter_dict, adapter_set, iteration, racon):
-    penalty, iters, window, order = 20, 3, 41, 2
-    for read in reads:
-        name, seq, qual = read[0], read[1], read[2]   
-        seq_len = len(seq)
-        if not adapter_dict.get(name):     #dict.get('key')=value
-            continue
-        strand = adapter_dict[name][1]     #dict['key'][indx] because the values of the 'key' is a list, etc
-        if strand == '-':
-            # use reverse complement of the splint
-            splint = splint_dict[adapter_dict[name][0]][1]
-        else:
-            splint = splint_dict[adapter_dict[name][0]][0]
-        scores = conk.conk(splint, seq, penalty)
-        peaks = call_peaks(scores, args.mdistcutoff, iters, window, order)
-        if not list(peaks):
-            continue
-        peaks = list(peaks + len(splint) // 2)
-        for i in range(len(peaks) - 1, -1, -1):
-            if peaks[i] >= seq_len:
-                del peaks[i]
-        if not peaks:
-            continue
+# racon scratch directory of each read thread
+THREAD_SCRATCH = threading.local()
 
-        # check for outliers in subread length
-        subreads, qual_subreads, dangling_subreads, qual_dangling_subreads = [], [], [], []
-        if len(peaks) > 1:
-            subread_lens = np.diff(peaks)
-            subread_lens = [rounding(x, 50) for x in subread_lens]
-            median_subread_len = np.median(subread_lens)
-            for i in range(len(subread_lens)):
-                bounds = [peaks[i], peaks[i+1]]
-                if median_subread_len*0.8 <= subread_lens[i] <= median_subread_len*1.2:
-                    subreads.append(seq[bounds[0]:bounds[1]])
-                    qual_subreads.append(qual[bounds[0]:bounds[1]])
-            if peaks[0] > 100:
-                dangling_subreads.append(seq[:peaks[0]])
-                qual_dangling_subreads.append(qual[:peaks[0]])
-            if seq_len - peaks[-1] > 100:
-                dangling_subreads.append(seq[peaks[-1]:])
-                qual_dangling_subreads.append(qual[peaks[-1]:])
+def call_read(args, read, splint, racon, scratch_dir, subread_file, cache=None):
+    '''
+    Consensus of one read given the splint sequence on its strand.
+    Returns (consensus, repeats, used, path, peaks), used is the number of
+    subreads abPOA aligned and path is no_peaks if the splint was not found in
+    the read, guard_length or guard_peaks if the read is over those guards.
+    Subreads are appended to subread_file if given, a path or an open file
+    (e.g. the buffer of a read thread) that is left open.
+    '''
+    penalty, iters, window, order = 20, 3, 41, 2
+    peak_params = (args.mdistcutoff, penalty, iters, window, order)
+    seq, qual = read[1], read[2]
+    if args.guard_length and len(seq) > args.guard_length:
+        return '', 0, 0, 'guard_length', []
+    coarse = args.coarse_scoring and len(seq) >= args.coarse_scoring
+    if coarse:
+        peak_params += ('coarse',)
+    peaks = cache.get('peaks', digest(seq, splint, peak_params)) if cache else None
+    if peaks is None:
+        if coarse:
+            peaks = coarse_read_peaks(seq, splint, args.mdistcutoff, penalty, iters, window, order)
         else:
-            dangling_subreads.append(seq[:peaks[0]])
-            qual_dangling_subreads.append(qual[:peaks[0]])
-            dangling_subreads.append(seq[peaks[0]:])
-            qual_dangling_subreads.append(qual[peaks[0]:])
-
-        tmp_dir = args.out_path + adapter_dict[name][0] + '/tmp' + str(iteration) + '/'
-        if not os.path.isdir(tmp_dir):
-            os.mkdir(tmp_dir)
-        subread_file = tmp_dir + 'subreads.fastq'
+            peaks = read_peaks(seq, splint, args.mdistcutoff, penalty, iters, window, order)
+        if cache:
+            cache.put('peaks', digest(seq, splint, peak_params), peaks)
+    if not peaks:
+        return '', 0, 0, 'no_peaks', peaks
+    if args.guard_peaks and len(peaks) > args.guard_peaks:
+        return '', 0, 0, 'guard_peaks', peaks
 
-        consensus, repeats = determine_consensus(
+    subreads, qual_subreads, dangling_subreads, qual_dangling_subreads = split_read(seq, qual, peaks)
+    bounds = subread_bounds(len(seq), peaks)
+    read_key = digest(seq, qual, peaks)
+    if args.max_subreads and len(subreads) > args.max_subreads:
+        read_key = digest(read_key, args.max_subreads, args.extra_subreads)
+    if args.guard_subreads and len(subreads) > args.guard_subreads:
+        read_key = digest(read_key, 'guard_subreads', args.guard_subreads)
+    if hasattr(subread_file, 'write'):
+        subread_fh = subread_file
+    else:
+        # callers that keep results in memory pass no file
+        subread_fh = open(subread_file, 'a+') if subread_file else open(os.devnull, 'w')
+    try:
+        consensus, repeats, path, used = determine_consensus(
             args, read, subreads, qual_subreads, dangling_subreads, qual_dangling_subreads,
-            racon, tmp_dir, subread_file
+            racon, scratch_dir, subread_fh,
+            cache=cache, read_key=read_key, bounds=bounds
         )
+    finally:
+        if subread_fh is not subread_file:
+            subread_fh.close()
+    return consensus, repeats, used, path, peaks
+
+def lift_guards(args):
+    '''Copy of args for the slow lane, without the guards that send reads there'''
+    slow_args = argparse.Namespace(**vars(args))
+    slow_args.guard_length, slow_args.guard_peaks = 0, 0
+    return slow_args
+
+def thread_scratch(scratch_dir):
+    '''Each read thread of a worker gets its own set of racon files'''
+    if getattr(THREAD_SCRATCH, 'parent', None) != scratch_dir:
+        THREAD_SCRATCH.parent = scratch_dir
+        THREAD_SCRATCH.path = make_scratch(scratch_dir, 'thread_')
+    return THREAD_SCRATCH.path
+
+def analyze_reads(args, reads, splint_dict, adapter_dict, adapter_set, iteration, racon):
+    stats = new_stats()
+    cache = ResultCache(args.cache) if args.cache else None
+    # per tmp dir: results table rows and the byte offset of the next consensus record
+    table_rows, cons_offsets = {}, {}
+    # one scratch directory per worker, racon's files in it are reused for every read
+    if args.scratch:
+        scratch_dir = make_scratch(args.scratch, 'c3poa_' + str(iteration) + '_')
+    else:
+        scratch_dir = make_scratch(args.out_path + 'tmp/', 'scratch' + str(iteration) + '_')
+    subread_name = 'subreads.tsv' if args.subread_output == 'coords' else 'subreads.fastq'
+    # reads of a shared memory batch are only decoded when they are called
+    names = reads.names() if hasattr(reads, 'names') else [read[0] for read in reads]
+    assigned, adapters = [], set()
+    for i, name in enumerate(names):
+        if adapter_dict.get(name):
+            assigned.append(i)
+            adapters.add(adapter_dict[name][0])
+    for adapter in adapters:
+        if not os.path.isdir(args.out_path + adapter + '/tmp' + str(iteration)):
+            os.mkdir(args.out_path + adapter + '/tmp' + str(iteration))
+
+    def call(i):
+        '''call_read for one read, with --readThreads its subreads come back as text'''
+        read = reads[i]
+        adapter, strand = adapter_dict[read[0]]
+        # use reverse complement of the splint on the - strand
+        splint = splint_dict[adapter][1] if strand == '-' else splint_dict[adapter][0]
+        if args.readThreads <= 1:
+            tmp_dir = args.out_path + adapter + '/tmp' + str(iteration) + '/'
+            return read, call_read(args, read, splint, racon, scratch_dir, tmp_dir + subread_name, cache), ''
+        buffer = io.StringIO()
+        result = call_read(args, read, splint, racon, thread_scratch(scratch_dir), buffer, cache)
+        return read, result, buffer.getvalue()
+
+    slow_reads = []
+    if args.readThreads > 1:
+        # native code and racon waits overlap, results still come back in read order
+        thread_pool = ThreadPool(args.readThreads)
+        results = thread_pool.imap(call, assigned)
+    else:
+        results = map(call, assigned)
+    for read, result, subread_text in results:
+        name, seq, qual = read[0], read[1], read[2]
+        seq_len = len(seq)
+        strand = adapter_dict[name][1]
+        tmp_dir = args.out_path + adapter_dict[name][0] + '/tmp' + str(iteration) + '/'
+        consensus, repeats, used, path, peaks = result
+        if subread_text:
+            subread_out = open(tmp_dir + subread_name, 'a+')
+            subread_out.write(subread_text)
+            subread_out.close()
+        if path == 'no_peaks':
+            count(stats, 'no_peaks')
+            continue
+        if path.startswith('guard_'):
+            count(stats, path)
+            if args.guard_action == 'slow_lane':
+                slow_reads.append(read)
+            continue
+        count(stats, 'path_' + path)
+        if args.guard_subreads and repeats > args.guard_subreads:
+            count(stats, 'guard_subreads')
+        elif used < repeats:
+            count(stats, 'subread_budget')
+            count(stats, 'subreads_over_budget', repeats - used)
+        path_out = open(tmp_dir + 'polish_paths.tsv', 'a+')
+        print(name, repeats, path, used, sep='\t', file=path_out)
+        path_out.close()
 
         if consensus:
-            avg_qual = round(sum([ord(x)-33 for x in qual])/seq_len, 2)
+            avg_qual = round(average_quality(qual), 2)
             cons_len = len(consensus)
+            header = '>' + name + '_' + '_'.join([str(x) for x in [avg_qual, seq_len, repeats, cons_len]])
             final_out = open(tmp_dir + '/R2C2_Consensus.fasta', 'a+')
-            print('>' + name + '_' + '_'.join([str(x) for x in [avg_qual, seq_len, repeats, cons_len]]), file=final_out)
+            print(header, file=final_out)
             print(consensus, file=final_out)
             final_out.close()
+            add_read(stats, adapter_dict[name][0], repeats, avg_qual, seq_len, cons_len)
+            offset = cons_offsets.get(tmp_dir, 0)
+            table_rows.setdefault(tmp_dir, []).append((
+                name, adapter_dict[name][0], strand, avg_qual, seq_len,
+                repeats, used, cons_len, len(peaks), offset
+            ))
+            cons_offsets[tmp_dir] = offset + len(header) + len(consensus) + 2
+    if args.readThreads > 1:
+        thread_pool.close()
+        thread_pool.join()
+    for tmp_dir, rows in table_rows.items():
+        write_rows(rows, tmp_dir + 'R2C2_Consensus.npy')
+    if slow_reads:
+        # main picks these up once every group is done
+        slow_fh = open(args.out_path + 'tmp/slow_lane' + str(iteration) + '.fastq', 'w+')
+        for name, seq, qual in slow_reads:
+            print('@{name}\n{seq}\n+\n{qual}'.format(name=name, seq=seq, qual=qual), file=slow_fh)
+        slow_fh.close()
+    remove_scratch(scratch_dir)
+    for op, calls in racon_file_ops().items():
+        count(stats, 'racon_file_' + op, calls)
+    if hasattr(reads, 'close'):
+        reads.close()
+    if cache:
+        for stage in set(cache.hits) | set(cache.misses):
+            count(stats, 'cache_hit_' + stage, cache.hits.get(stage, 0))
+            count(stats, 'cache_miss_' + stage, cache.misses.get(stage, 0))
+        cache.close()
+    return stats
 
 def main(args):
     if not args.out_path.endswith('/'):
@@ -178,6 +406,10 @@ def main(args):
     if not os.path.exists(args.out_path):
         os.mkdir(args.out_path)
     log_file = open(args.out_path + 'c3poa.log', 'w+')
+    args.reads = resolve_inputs(args.reads)
+    if not args.reads:
+        print('No read files to process', file=sys.stderr)
+        sys.exit(1)
 
     if args.config:
         progs = configReader(args.out_path, args.config)
@@ -190,28 +422,68 @@ def main(args):
     tmp_dir = args.out_path + 'tmp/'
     if not os.path.isdir(tmp_dir):
         os.mkdir(tmp_dir)
+    if args.scratch and not os.path.isdir(args.scratch):
+        os.makedirs(args.scratch)
 
     # read in the file and preprocess
     read_list, total_reads = [], 0
-    short_reads = 0
+    short_reads, low_qual_reads = 0, 0
     tmp_fasta = tmp_dir + 'R2C2_temp_for_BLAT.fasta'
-    align_psl = tmp_dir + 'splint_to_read_alignments.psl'
 
     tmp_adapter_dict = {}
-    for read in mm.fastx_read(args.reads, read_comment=False):
+    # splint assignments of reads that are not cached yet (or all reads without a cache)
+    cache, blat_keys = None, {}
+    if args.cache:
+        cache = ResultCache(args.cache)
+        with open(args.splint_file) as f:
+            splint_key = digest(f.read())
+    for read in iter_reads(args.reads, args.readerProcs):
         if len(read[1]) < args.lencutoff:
             short_reads += 1
             continue
+        if args.qualcutoff and average_quality(read[2]) < args.qualcutoff:
+            low_qual_reads += 1
+            continue
         tmp_adapter_dict[read[0]] = [[None, 1, None]] # [adapter, matches, strand]
         total_reads += 1
-    adapter_dict, adapter_set, no_splint = preprocess(blat, args, tmp_dir, tmp_adapter_dict, total_reads)
+        if cache:
+            key = digest(read[1], splint_key)
+            best = cache.get('splint', key)
+            if best is None:
+                blat_keys[read[0]] = key
+            else:
+                tmp_adapter_dict[read[0]].append(best)
+    splint_dict = {}
+    for splint in mm.fastx_read(args.splint_file, read_comment=False):
+        splint_dict[splint[0]] = [splint[1]]
+        splint_dict[splint[0]].append(mm.revcomp(splint[1]))
+
+    if args.autotune and total_reads:
+        sample = []
+        for read in iter_reads(args.reads, args.readerProcs):
+            if read[0] in tmp_adapter_dict:
+                sample.append(read)
+                if len(sample) == args.autotune_reads:
+                    break
+        measured, tuned = autotune(args, sample, splint_dict, total_reads, blat, racon, analyze_reads)
+        report(measured, tuned, sys.stderr)
+
+    adapter_dict, adapter_set, no_splint = preprocess(
+        blat, args, tmp_dir, tmp_adapter_dict, total_reads,
+        blat_reads=blat_keys if cache else None
+    )
+    if cache:
+        for name, key in blat_keys.items():
+            cache.put('splint', key, sorted(tmp_adapter_dict[name], key=lambda x: x[1], reverse=True)[0])
+        cache.flush()
 
     for adapter in adapter_set:
         if not os.path.exists(args.out_path + adapter):
             os.mkdir(args.out_path + adapter)
 
-    all_reads = total_reads + short_reads
+    all_reads = total_reads + short_reads + low_qual_reads
     print('C3POa version:', VERSION, file=log_file)
+    print('Read files:', len(args.reads), file=log_file)
     print('Total reads:', all_reads, file=log_file)
     print('No splint reads:',
            no_splint,
@@ -221,31 +493,70 @@ def main(args):
            short_reads,
            '({:.2f}%)'.format((short_reads/all_reads)*100),
            file=log_file)
+    print('Under qual cutoff:',
+           low_qual_reads,
+           '({:.2f}%)'.format((low_qual_reads/all_reads)*100),
+           file=log_file)
+    thrown_away = short_reads + low_qual_reads + no_splint
     print('Total thrown away reads:',
-           short_reads + no_splint,
-           '({:.2f}%)'.format(((short_reads + no_splint)/all_reads)*100),
+           thrown_away,
+           '({:.2f}%)'.format((thrown_away/all_reads)*100),
            file=log_file)
-    print('Reads after preprocessing:', all_reads - (short_reads + no_splint), file=log_file)
+    print('Reads after preprocessing:', all_reads - thrown_away, file=log_file)
+    if args.autotune and total_reads:
+        report(measured, tuned, log_file)
     log_file.close()
 
-    splint_dict = {}
-    for splint in mm.fastx_read(args.splint_file, read_comment=False):
-        splint_dict[splint[0]] = [splint[1]]
-        splint_dict[splint[0]].append(mm.revcomp(splint[1]))
+    stats = new_stats()
+    def collect(group_stats):
+        merge_stats(stats, group_stats)
+        pbar.update(1)
 
+    if args.sweep:
+        # conk runs once per read, every grid setting is evaluated on its scores
+        grid = parse_grid(args.sweep, args.mdistcutoff)
+        summary = new_summary(grid)
+        def collect_sweep(group_summary):
+            merge_summary(summary, group_summary)
+            pbar.update(1)
+
+    profile_dir = tmp_dir + 'profile/' if args.profile else ''
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.mkdir(profile_dir)
+    # a block per group that is queued or running, reused once its worker is done
+    batches = None
+    if args.read_batches == 'shared_memory':
+        batches = BatchPool(args.inFlight if args.inFlight else 2 * args.numThreads)
     pool = mp.Pool(args.numThreads, maxtasksperchild=1)
-    pbar = tqdm(total=total_reads // args.groupSize + 1, desc='Calling consensi')
-    iteration, current_num, tmp_reads, target = 1, 0, [], args.groupSize
-    for read in mm.fastx_read(args.reads, read_comment=False):
-        if len(read[1]) < args.lencutoff:
+    def submit(function, group, function_args, callback):
+        '''apply_async of function(args, group, *function_args)'''
+        if not batches:
+            return pool.apply_async(*profiled(profile_dir, function, (args, group) + function_args),
+                                    callback=callback)
+        batch = batches.pack(group)
+        return pool.apply_async(*profiled(profile_dir, function, (args, batch) + function_args),
+                                callback=batches.released(batch, callback), error_callback=batches.released(batch))
+
+    pbar = tqdm(total=total_reads // args.groupSize + 1, desc='Sweeping' if args.sweep else 'Calling consensi')
+    iteration, current_num, tmp_reads, target = 1, 0, [], min(args.groupSize, total_reads)
+    pending = []
+    for read in iter_reads(args.reads, args.readerProcs):
+        # only reads that passed the length and quality filters
+        if read[0] not in tmp_adapter_dict:
             continue
         tmp_reads.append(read)
         current_num += 1
         if current_num == target:
-            pool.apply_async(analyze_reads,
-                args=(args, tmp_reads, splint_dict, adapter_dict, adapter_set, iteration, racon),
-                callback=lambda _: pbar.update(1)
-            )
+            if args.sweep:
+                result = submit(sweep_reads, tmp_reads, (splint_dict, adapter_dict, grid), collect_sweep)
+            else:
+                result = submit(analyze_reads, tmp_reads,
+                                (splint_dict, adapter_dict, adapter_set, iteration, racon), collect)
+            if args.inFlight:
+                # stop reading ahead while too many groups are queued or running
+                pending = [r for r in pending if not r.ready()] + [result]
+                while len(pending) > args.inFlight:
+                    pending.pop(0).wait()
             iteration += 1
             target = args.groupSize * iteration
             if target >= total_reads:
@@ -255,21 +566,129 @@ def main(args):
     pool.close()
     pool.join()
     pbar.close()
+    if batches:
+        batches.close()
+
+    # reads over --guard_length or --guard_peaks did not hold up their groups,
+    # they are called now, one per task so they spread over all processes
+    slow_reads = []
+    for slow_file in sorted(glob(tmp_dir + 'slow_lane*.fastq')):
+        slow_reads += list(mm.fastx_read(slow_file, read_comment=False))
+        os.remove(slow_file)
+    if slow_reads:
+        slow_args = lift_guards(args)
+        count(stats, 'slow_lane', len(slow_reads))
+        pool = mp.Pool(args.numThreads, maxtasksperchild=1)
+        pbar = tqdm(total=len(slow_reads), desc='Calling slow lane consensi')
+        for read in slow_reads:
+            pool.apply_async(*profiled(profile_dir, analyze_reads,
+                (slow_args, [read], splint_dict, adapter_dict, adapter_set, iteration, racon)),
+                callback=collect
+            )
+            iteration += 1
+        pool.close()
+        pool.join()
+        pbar.close()
+    if profile_dir:
+        # blat workers wrote their stacks here too
+        profile = merge_profiles(profile_dir, args.out_path + 'c3poa_profile.folded')
+        shutil.rmtree(profile_dir)
+        report_profile(profile, sys.stderr)
+
+    if args.sweep:
+        write_summary(grid, summary, args.out_path + 'c3poa_sweep.tsv')
+        print('Wrote', len(grid), 'sweep settings to', args.out_path + 'c3poa_sweep.tsv', file=sys.stderr)
+        return
+
+    log_file = open(args.out_path + 'c3poa.log', 'a+')
+    print('Polishing policy:', args.polish, file=log_file)
+    counters = stats['counters']
+    print('No peak reads:', counters.get('no_peaks', 0), file=log_file)
+    for path in ['racon', 'abpoa', 'zero', 'timeout', 'failed']:
+        print('Consensus path ' + path + ':', counters.get('path_' + path, 0), file=log_file)
+    guards = [('length', 'reads over', args.guard_length, 'bases'),
+              ('peaks', 'reads over', args.guard_peaks, 'peaks'),
+              ('subreads', 'reads capped and not polished with over', args.guard_subreads, 'subreads'),
+              ('timeout', 'racon runs stopped after', args.guard_timeout, 'seconds')]
+    for guard, description, limit, unit in guards:
+        if limit:
+            fired = counters.get('path_timeout' if guard == 'timeout' else 'guard_' + guard, 0)
+            print('Guard ' + guard + ', ' + description, limit, unit + ':', fired, file=log_file)
+    if args.guard_length or args.guard_peaks:
+        if args.guard_action == 'slow_lane':
+            print('Slow lane reads:', counters.get('slow_lane', 0), file=log_file)
+        else:
+            print('Reads skipped by guards:',
+                  counters.get('guard_length', 0) + counters.get('guard_peaks', 0), file=log_file)
+    if args.max_subreads:
+        print('Subread budget:', args.max_subreads, '(extra subreads: ' + args.extra_subreads + ')', file=log_file)
+        print('Reads over the subread budget:', counters.get('subread_budget', 0), file=log_file)
+        print('Subreads over the budget ' + ('polished with' if args.extra_subreads == 'polish' else 'dropped') + ':',
+              counters.get('subreads_over_budget', 0), file=log_file)
+    if profile_dir:
+        report_profile(profile, log_file)
+    # what the parent spends reading, batching and handing out groups (workers not included)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print('Read batches:', args.read_batches, file=log_file)
+    print('Parent CPU seconds:', round(usage.ru_utime + usage.ru_stime, 2), file=log_file)
+    print('Parent peak RSS (MB):', round(usage.ru_maxrss * MAXRSS_UNIT / 1e6, 1), file=log_file)
+    for splint in sorted(stats['splints']):
+        print('Consensus reads ' + splint + ':', stats['splints'][splint]['reads'], file=log_file)
+    # racon's 5 files are reused slots in a scratch directory per worker (and read
+    # thread), the workers count the metadata calls they make on them
+    racon_runs = counters.get('path_racon', 0) + counters.get('path_timeout', 0)
+    print('Racon scratch directory:', args.scratch if args.scratch else tmp_dir, file=log_file)
+    print('Racon runs:', racon_runs, file=log_file)
+    print('Racon scratch metadata calls' + ('' if args.scratch else ' on out_path') + ':',
+          ', '.join(str(counters.get('racon_file_' + op, 0)) + ' ' + op for op in RACON_FILE_OPS),
+          file=log_file)
+    if cache:
+        count(stats, 'cache_hit_splint', cache.hits.get('splint', 0))
+        count(stats, 'cache_miss_splint', cache.misses.get('splint', 0))
+        for stage in ['splint', 'peaks', 'zero', 'abpoa', 'racon']:
+            hits, misses = counters.get('cache_hit_' + stage, 0), counters.get('cache_miss_' + stage, 0)
+            print('Cache hits ' + stage + ':', hits, '/', hits + misses,
+                  '({:.2f}%)'.format(hits / max(hits + misses, 1) * 100), file=log_file)
+        evicted = cache.evict(args.cache_size * 1000000)
+        print('Cache results evicted:', evicted, file=log_file)
+        cache.close()
+    log_file.close()
+    write_stats(stats, args.out_path + 'c3poa_stats.json')
+
+    # the table offsets are per group, shift them by the groups catted before them
+    table_parts = []
+    for adapter in adapter_set:
+        base = 0
+        for cons_file in sorted(glob(args.out_path + adapter + '/tmp*/R2C2_Consensus.fasta')):
+            table_parts.append((cons_file[:-len('fasta')] + 'npy', base))
+            base += os.path.getsize(cons_file)
+    merge_tables(table_parts, args.out_path + 'R2C2_Consensus_table.npy')
 
+    merged = [0, 0, 0, 0, 0]
     for adapter in adapter_set:
-        cat_files(
+        add_merge(merged, cat_files(
             args.out_path + adapter,
             '/tmp*/R2C2_Consensus.fasta',
             args.out_path + adapter + '/R2C2_Consensus.fasta',
             'Catting consensus reads', compress=args.compress_output
-        )
-        cat_files(
+        ))
+        subread_ext = 'tsv' if args.subread_output == 'coords' else 'fastq'
+        add_merge(merged, cat_files(
             args.out_path + adapter,
-            '/tmp*/subreads.fastq',
-            args.out_path + adapter + '/R2C2_Subreads.fastq',
+            '/tmp*/subreads.' + subread_ext,
+            args.out_path + adapter + '/R2C2_Subreads.' + subread_ext,
             'Catting subreads', compress=args.compress_output
-        )
+        ))
+        add_merge(merged, cat_files(
+            args.out_path + adapter,
+            '/tmp*/polish_paths.tsv',
+            args.out_path + adapter + '/R2C2_Polish_Paths.tsv',
+            'Catting polishing paths', compress=False
+        ))
         remove_files(args.out_path + adapter, '/tmp*')
+    log_file = open(args.out_path + 'c3poa.log', 'a+')
+    report_merge(merged, log_file)
+    log_file.close()
 
 if __name__ == '__main__':
     args = parse_args()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+from collections import namedtuple, deque
+import mappy as mm
+
+PATH = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/bin/'
+sys.path.append(os.path.abspath(PATH))
+
+from C3POa import build_parser, call_read, average_quality, lift_guards
+from determine_consensus import make_scratch, remove_scratch, racon_file_ops
+from preprocess import process, assign_splints
+from qc_stats import new_stats, count, add_read, merge_stats
+from result_cache import ResultCache
+
+class ConsensusRecord(namedtuple('ConsensusRecord', ['name', 'consensus', 'splint', 'strand', 'avg_qual',
+                                                     'seq_len', 'repeats', 'subreads_used', 'cons_len',
+                                                     'peaks', 'path'])):
+    '''
+    One consensus read, path is how it was made (racon, abpoa or zero) and
+    subreads_used how many subreads abPOA aligned (see max_subreads)
+    '''
+    def header(self):
+        '''The name C3POa.py writes: name_avgQual_readLength_repeats_consLength'''
+        return '_'.join([self.name] + [str(x) for x in [self.avg_qual, self.seq_len, self.repeats, self.cons_len]])
+
+def group_splints(args, reads, blat):
+    '''
+    read name: [splint, strand] for the reads of a group with a splint alignment.
+    blat runs in the calling process on a temporary fasta, nothing is saved.
+    '''
+    work = tempfile.mkdtemp(prefix='c3poa_api_blat_', dir=args.scratch if args.scratch else None) + '/'
+    blat_args = argparse.Namespace(**vars(args))
+    blat_args.out_path = work
+    try:
+        best, adapters = process(blat_args, reads, blat, 'group')
+    finally:
+        shutil.rmtree(work)
+    adapter_dict, _, _ = assign_splints({read[0]: [[None, 1, None]] for read in reads}, best, adapters)
+    return adapter_dict
+
+def call_group(args, reads, splint_dict, adapter_dict, racon, blat='blat'):
+    '''
+    Returns the consensus records and QC stats of a group of reads. Without an
+    adapter_dict the group's splints are assigned with blat first, in the same
+    process. Reads over guard_length or guard_peaks are called after the rest
+    of the group.
+    '''
+    if adapter_dict is None:
+        adapter_dict = group_splints(args, reads, blat)
+    stats = new_stats()
+    cache = ResultCache(args.cache) if args.cache else None
+    scratch_dir = make_scratch(args.scratch if args.scratch else None, 'c3poa_api_')
+    records, slow_reads = [], []
+    for read in reads:
+        name, seq, qual = read[0], read[1], read[2]
+        if not adapter_dict.get(name):
+            count(stats, 'no_splint')
+            continue
+        adapter, strand = adapter_dict[name]
+        splint = splint_dict[adapter][1] if strand == '-' else splint_dict[adapter][0]
+        consensus, repeats, used, path, peaks = call_read(args, read, splint, racon, scratch_dir, '', cache)
+        if path.startswith('guard_'):
+            count(stats, path)
+            if args.guard_action == 'slow_lane':
+                slow_reads.append(read)
+            continue
+        count(stats, path if path == 'no_peaks' else 'path_' + path)
+        if args.guard_subreads and repeats > args.guard_subreads:
+            count(stats, 'guard_subreads')
+        elif used < repeats:
+            count(stats, 'subread_budget')
+            count(stats, 'subreads_over_budget', repeats - used)
+        if consensus:
+            avg_qual = round(average_quality(qual), 2)
+            records.append(ConsensusRecord(name, consensus, adapter, strand, avg_qual, len(seq),
+                                           repeats, used, len(consensus), len(peaks), path))
+            add_read(stats, adapter, repeats, avg_qual, len(seq), len(consensus))
+    remove_scratch(scratch_dir)
+    for op, calls in racon_file_ops().items():
+        count(stats, 'racon_file_' + op, calls)
+    if cache:
+        cache.close()
+    if slow_reads:
+        count(stats, 'slow_lane', len(slow_reads))
+        slow_records, slow_stats = call_group(lift_guards(args), slow_reads, splint_dict, adapter_dict, racon)
+        records += slow_records
+        merge_stats(stats, slow_stats)
+    return records, stats
+
+def known_splints(adapter_dict, group):
+    '''The part of a given adapter_dict a group needs, None to assign its splints'''
+    if adapter_dict is None:
+        return None
+    return {read[0]: adapter_dict[read[0]] for read in group if read[0] in adapter_dict}
+
+class ConsensusCaller:
+    '''
+    Calls R2C2 consensus reads from reads held in memory.
+
+        caller = ConsensusCaller('splint.fasta', threads=8, polish='adaptive')
+        for record in caller.call(reads):    # (name, seq, qual) tuples
+            print('>' + record.header(), record.consensus, sep='\n')
+
+    Options are the long C3POa.py options (mdistcutoff, lencutoff, qualcutoff,
+    zero, polish, scratch, cache, ...) with the same defaults. Splints are
+    assigned with blat by the process that calls the group, on a temporary
+    file, so with threads above 1 the groups are aligned in parallel.
+    '''
+    def __init__(self, splint_file, threads=1, group_size=1000, blat='blat', racon='racon', **options):
+        args = build_parser().parse_args([])
+        unknown = [option for option in options if not hasattr(args, option)]
+        if unknown:
+            raise TypeError('Unknown C3POa options: ' + ', '.join(unknown))
+        for option, value in options.items():
+            setattr(args, option, value)
+        args.splint_file = os.path.abspath(splint_file)
+        args.numThreads, args.groupSize = threads, group_size
+        self.args, self.blat, self.racon = args, blat, racon
+        self.splint_dict = {}
+        for name, seq, _ in mm.fastx_read(splint_file, read_comment=False):
+            self.splint_dict[name] = [seq, mm.revcomp(seq)]
+        self.stats = new_stats()
+
+    def assign_splints(self, reads):
+        '''Returns read name: [splint, strand] for reads with a splint alignment'''
+        return group_splints(self.args, reads, self.blat)
+
+    def groups(self, reads):
+        '''Filters reads like C3POa.py and yields groups of group_size'''
+        group = []
+        for read in reads:
+            if len(read[1]) < self.args.lencutoff:
+                count(self.stats, 'under_len_cutoff')
+                continue
+            if self.args.qualcutoff and average_quality(read[2]) < self.args.qualcutoff:
+                count(self.stats, 'under_qual_cutoff')
+                continue
+            group.append(tuple(read[:3]))
+            if len(group) == self.args.groupSize:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    def call(self, reads, adapter_dict=None):
+        '''
+        Yields a ConsensusRecord for every read that gets a consensus, in input
+        order (slow lane reads at the end of their group). adapter_dict (name: [splint, strand]) skips blat if the splints
+        are already known. QC statistics accumulate in self.stats.
+        '''
+        if self.args.numThreads <= 1:
+            for group in self.groups(reads):
+                records, stats = call_group(self.args, group, self.splint_dict,
+                                            known_splints(adapter_dict, group), self.racon, self.blat)
+                merge_stats(self.stats, stats)
+                for record in records:
+                    yield record
+            return
+        # spawned workers like C3POa.py, whatever start method the host program uses
+        pool = mp.get_context('spawn').Pool(self.args.numThreads)
+        try:
+            pending = deque()
+            for group in self.groups(reads):
+                pending.append(pool.apply_async(call_group, (self.args, group, self.splint_dict,
+                                                             known_splints(adapter_dict, group),
+                                                             self.racon, self.blat)))
+                while len(pending) > 2 * self.args.numThreads:
+                    for record in self.collect(pending.popleft()):
+                        yield record
+            while pending:
+                for record in self.collect(pending.popleft()):
+                    yield record
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def collect(self, result):
+        records, stats = result.get()
+        merge_stats(self.stats, stats)
+        return records
@@ -9,10 +9,17 @@ from tqdm import tqdm
 import multiprocessing as mp
 import editdistance as ld
 from glob import glob
-import gzip
 import shutil
 
+PATH = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/bin/'
+sys.path.append(os.path.abspath(PATH))
+
+from profiler import waiting, profiled, run_profiled, merge_profiles, report_profile
+from concat import merge_files, add_merge, report_merge
+
 VERSION = 'v2.2.3'
+# reads held in memory at a time by the single process streaming path
+STREAM_WINDOW = 10000
 
 def parse_args():
     '''Parses arguments.'''
@@ -52,6 +59,10 @@ def parse_args():
                         help='Number of reads processed by each thread in each iteration. Defaults to 1000.')
     parser.add_argument('--blatThreads', '-bt', action='store_true', default=False,
                         help='''Use to chunk blat across the number of threads instead of by groupSize (faster).''')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='''Sample the stacks of every worker and merge them into
+                                postprocessing_profile.folded (collapsed stacks for flame graphs).
+                                Time spent waiting on blat has its own root.''')
     parser.add_argument('--compress_output', '-co', action='store_true', default=False,
                         help='Use to compress (gzip) both the consensus fasta and subread fastq output files.')
     parser.add_argument('--version', '-v', action='version', version=VERSION, help='Prints the C3POa version.')
@@ -89,20 +100,9 @@ def get_file_len(inFile):
         count += 1
     return count
 
-def cat_files(path, pattern, output, pos, compress):
+def cat_files(path, pattern, output, compress):
     '''Use glob to get around bash argument list limitations'''
-    if compress:
-        output += '.gz'
-        final_fh = gzip.open(output, 'wb+')
-    else:
-        final_fh = open(output, 'w+')
-    for f in tqdm(glob(path + pattern), position=pos):
-        with open(f) as fh:
-            for line in fh:
-                if compress:
-                    line = line.encode()
-                final_fh.write(line)
-    final_fh.close()
+    return merge_files(glob(path + pattern), output, compress)
 
 def remove_files(path, pattern):
     '''Use glob to get around bash argument list limitations'''
@@ -139,6 +139,9 @@ def chunk_process(num_reads, args, blat):
     else:
         idx_to_seq, seq_to_idx = {}, {}
 
+    profile_dir = args.output_path + 'post_profile/' if args.profile else ''
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.mkdir(profile_dir)
     pool = mp.Pool(args.threads)
     pbar = tqdm(total=num_reads // chunk_size + 1, desc='Aligning with BLAT and processing')
     iteration, current_num, tmp_reads, target = 1, 0, {}, chunk_size
@@ -147,8 +150,7 @@ def chunk_process(num_reads, args, blat):
         current_num += 1
         if current_num == target:
             pool.apply_async(
-                process,
-                args=(args, tmp_reads, blat, iteration, idx_to_seq, seq_to_idx),
+                *profiled(profile_dir, process, (args, tmp_reads, blat, iteration, idx_to_seq, seq_to_idx)),
                 callback=lambda _: pbar.update(1)
             )
             iteration += 1
@@ -163,8 +165,9 @@ def chunk_process(num_reads, args, blat):
     flc = 'R2C2_full_length_consensus_reads.fasta'
     flc_left = 'R2C2_full_length_consensus_reads_left_splint.fasta'
     flc_right = 'R2C2_full_length_consensus_reads_right_splint.fasta'
-    pool = mp.Pool(args.threads)
+    # sequential appends, the kernel does the copying so a pool only adds seeks
     print('Catting files', file=sys.stderr)
+    merged = [0, 0, 0, 0, 0]
     if idx_to_seq:
         idx_to_seq['no_index_found'] = ''
         for idx in idx_to_seq.keys():
@@ -172,48 +175,26 @@ def chunk_process(num_reads, args, blat):
             if not os.path.isdir(args.output_path + idx):
                 os.mkdir(args.output_path + idx)
             pattern = 'post_tmp*/' + idx
-            pool.apply_async(cat_files, args=(
-                    args.output_path,
-                    pattern + flc,
-                    args.output_path + idx + flc,
-                    0, args.compress_output))
-            pool.apply_async(cat_files, args=(
-                    args.output_path,
-                    pattern + flc_left,
-                    args.output_path + idx + flc_left,
-                    1, args.compress_output))
-            pool.apply_async(cat_files, args=(
-                    args.output_path,
-                    pattern + flc_right,
-                    args.output_path + idx + flc_right,
-                    2, args.compress_output))
+            for final in [flc, flc_left, flc_right]:
+                add_merge(merged, cat_files(args.output_path, pattern + final,
+                                            args.output_path + idx + final, args.compress_output))
         mux_tsvs = 'post_tmp*/R2C2_oligodT_multiplexing.tsv'
         mux_tsv_final = args.output_path + 'R2C2_oligodT_multiplexing.tsv'
-        pool.apply_async(cat_files, args=(args.output_path, mux_tsvs, mux_tsv_final, 3, False))
+        add_merge(merged, cat_files(args.output_path, mux_tsvs, mux_tsv_final, False))
     else:
         pattern = 'post_tmp*/'
-        pool.apply_async(cat_files, args=(
-                args.output_path,
-                pattern + flc,
-                args.output_path + flc,
-                0, args.compress_output))
-        pool.apply_async(cat_files, args=(
-                args.output_path,
-                pattern + flc_left,
-                args.output_path + flc_left,
-                1, args.compress_output))
-        pool.apply_async(cat_files, args=(
-                args.output_path,
-                pattern + flc_right,
-                args.output_path + flc_right,
-                2, args.compress_output))
+        for final in [flc, flc_left, flc_right]:
+            add_merge(merged, cat_files(args.output_path, pattern + final,
+                                        args.output_path + final, args.compress_output))
         if args.barcoded:
             flc_bc = pattern + 'R2C2_full_length_consensus_reads_10X_sequences.fasta'
             flc_bc_final = args.output_path + 'R2C2_full_length_consensus_reads_10X_sequences.fasta'
-            pool.apply_async(cat_files, args=(args.output_path, flc_bc, flc_bc_final, 3, args.compress_output))
-    pool.close()
-    pool.join()
+            add_merge(merged, cat_files(args.output_path, flc_bc, flc_bc_final, args.compress_output))
+    report_merge(merged, sys.stderr)
     remove_files(args.output_path, 'post_tmp*')
+    if profile_dir:
+        report_profile(merge_profiles(profile_dir, args.output_path + 'postprocessing_profile.folded'), sys.stderr)
+        shutil.rmtree(profile_dir)
 
 def read_fasta(inFile, indexes):
     '''Reads in FASTA files, returns a dict of header:sequence'''
@@ -229,40 +210,106 @@ def read_fasta(inFile, indexes):
 def run_blat(path, infile, adapter_fasta, blat):
     align_psl = path + 'adapter_to_consensus_alignment.psl'
     if not os.path.exists(align_psl) or os.stat(align_psl).st_size == 0:
-        os.system('{blat} -noHead -stepSize=1 -tileSize=6 -t=DNA -q=DNA -minScore=10 \
-                  -minIdentity=10 -minMatch=1 -oneOff=1 {adapters} {reads} {psl} >{blat_msgs}'
-                  .format(blat=blat, adapters=adapter_fasta, reads=infile, psl=align_psl, blat_msgs=path + 'blat_msgs.log'))
+        with waiting('blat'):
+            os.system('{blat} -noHead -stepSize=1 -tileSize=6 -t=DNA -q=DNA -minScore=10 \
+                      -minIdentity=10 -minMatch=1 -oneOff=1 {adapters} {reads} {psl} >{blat_msgs}'
+                      .format(blat=blat, adapters=adapter_fasta, reads=infile, psl=align_psl, blat_msgs=path + 'blat_msgs.log'))
     else:
         print('Reading existing psl file', file=sys.stderr)
 
+def new_adapter_entry(sequence):
+    '''Placeholder hits at the read ends, so reads without adapters still sort'''
+    return {'+': [('-', 1, 0)], '-': [('-', 1, len(sequence))]}
+
+def parse_psl_line(line):
+    '''Returns (read_name, strand, (adapter, score, position)) or None for a weak hit'''
+    a = line.strip().split('\t')
+    read_name, adapter, strand = a[9], a[13], a[8]
+    if int(a[5]) < 50 and float(a[0]) > 10:
+        if strand == '+':
+            start = int(a[11]) - int(a[15])
+            end = int(a[12]) + (int(a[14]) - int(a[16]))
+            position = end
+        if strand == '-':
+            start = int(a[11]) - (int(a[14]) - int(a[16]))
+            end = int(a[12]) + int(a[15])
+            position = start
+        return read_name, strand, (adapter, float(a[0]), position)
+    return None
+
 def parse_blat(path, reads):
-    adapter_dict, iterator = {}, 0
+    adapter_dict = {}
 
     for name, sequence in reads.items():
-        adapter_dict[name] = {}
-        adapter_dict[name]['+'] = []
-        adapter_dict[name]['-'] = []
-        adapter_dict[name]['+'].append(('-', 1, 0))
-        adapter_dict[name]['-'].append(('-', 1, len(sequence)))
+        adapter_dict[name] = new_adapter_entry(sequence)
 
     with open(path + 'adapter_to_consensus_alignment.psl') as f:
         for line in f:
-            a = line.strip().split('\t')
-            read_name, adapter, strand = a[9], a[13], a[8]
-            if int(a[5]) < 50 and float(a[0]) > 10:
-                if strand == '+':
-                    start = int(a[11]) - int(a[15])
-                    end = int(a[12]) + (int(a[14]) - int(a[16]))
-                    position = end
-                if strand == '-':
-                    start = int(a[11]) - (int(a[14]) - int(a[16]))
-                    end = int(a[12]) + int(a[15])
-                    position = start
-                adapter_dict[read_name][strand].append((adapter,
-                                                        float(a[0]),
-                                                        position))
+            hit = parse_psl_line(line)
+            if hit:
+                read_name, strand, adapter = hit
+                adapter_dict[read_name][strand].append(adapter)
     return adapter_dict
 
+def psl_groups(psl_file):
+    '''Yields (read_name, hits) for runs of consecutive psl lines of the same read'''
+    name, hits = None, []
+    with open(psl_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            read_name = line.split('\t', 10)[9]
+            if read_name != name:
+                if name is not None:
+                    yield name, hits
+                name, hits = read_name, []
+            hit = parse_psl_line(line)
+            if hit:
+                hits.append(hit[1:])
+    if name is not None:
+        yield name, hits
+
+def read_windows(inFile, size):
+    '''Yields dicts of header:sequence with up to size reads, in file order'''
+    window = {}
+    for read in mm.fastx_read(inFile, read_comment=False):
+        window[read[0]] = read[1]
+        if len(window) == size:
+            yield window
+            window = {}
+    if window:
+        yield window
+
+def stream_process(args, blat, idx_to_seq, seq_to_idx):
+    '''
+    Single process postprocessing with memory bounded by STREAM_WINDOW reads.
+    BLAT writes the hits of each query together and in input order, so windows
+    of reads and the psl are walked in lock-step instead of loading either.
+    '''
+    run_blat(args.output_path, args.input_fasta_file, args.adapter_file, blat)
+    groups = psl_groups(args.output_path + 'adapter_to_consensus_alignment.psl')
+    pending = next(groups, None)
+    unmatched, append = 0, False
+    pbar = tqdm(desc='Processing reads', unit=' reads')
+    for reads in read_windows(args.input_fasta_file, STREAM_WINDOW):
+        adapter_dict = {name: new_adapter_entry(sequence) for name, sequence in reads.items()}
+        # take hits until the psl reaches a read of a later window
+        while pending and pending[0] in adapter_dict:
+            for strand, adapter in pending[1]:
+                adapter_dict[pending[0]][strand].append(adapter)
+            pending = next(groups, None)
+        write_fasta_file(args, args.output_path, adapter_dict, reads, seq_to_idx, idx_to_seq, append=append)
+        append = True
+        pbar.update(len(reads))
+    pbar.close()
+    while pending:
+        unmatched += 1
+        pending = next(groups, None)
+    if unmatched:
+        print('Warning: adapter hits of', unmatched, 'reads were not in input order and were not used.'
+              ' Remove the psl file in the output path if it was made from a different input.',
+              file=sys.stderr)
+
 def match_index(seq, seq_to_idx):
     dist_dict, dist_list = {}, []
     # there needs to be a better/more efficient way to do this.
@@ -284,26 +331,28 @@ def match_index(seq, seq_to_idx):
     else:
         return '-'
 
-def write_fasta_file(args, path, adapter_dict, reads, seq_to_idx, idx_to_seq):
+def write_fasta_file(args, path, adapter_dict, reads, seq_to_idx, idx_to_seq, append=False, progress=False):
+    '''Writes the reoriented reads, append adds to the files of a previous call'''
     undirectional = args.undirectional
     barcoded = args.barcoded
     trim = args.trim
 
     odT = True if seq_to_idx else False
 
+    mode = 'a' if append else 'w'
     if barcoded:
-        out10X = open(path + 'R2C2_full_length_consensus_reads_10X_sequences.fasta', 'w')
+        out10X = open(path + 'R2C2_full_length_consensus_reads_10X_sequences.fasta', mode)
     if odT:
-        outdT = open(path + 'R2C2_oligodT_multiplexing.tsv', 'w')
+        outdT = open(path + 'R2C2_oligodT_multiplexing.tsv', mode)
         for idx in idx_to_seq:
-            if os.path.exists(path + idx):
+            if not append and os.path.exists(path + idx):
                 shutil.rmtree(path + idx)
     else:
-        out = open(path + 'R2C2_full_length_consensus_reads.fasta', 'w')
-        out3 = open(path + 'R2C2_full_length_consensus_reads_left_splint.fasta', 'w')
-        out5 = open(path + 'R2C2_full_length_consensus_reads_right_splint.fasta', 'w')
+        out = open(path + 'R2C2_full_length_consensus_reads.fasta', mode)
+        out3 = open(path + 'R2C2_full_length_consensus_reads_left_splint.fasta', mode)
+        out5 = open(path + 'R2C2_full_length_consensus_reads_right_splint.fasta', mode)
 
-    for name, sequence in (tqdm(reads.items()) if args.threads==1  else reads.items()):
+    for name, sequence in (tqdm(reads.items()) if progress else reads.items()):
         adapter_plus = sorted(adapter_dict[name]['+'],
                               key=lambda x: x[2], reverse=False)
         adapter_minus = sorted(adapter_dict[name]['-'],
@@ -415,16 +464,21 @@ def main(args):
         num_reads = get_file_len(args.input_fasta_file)
         chunk_process(num_reads, args, blat)
     else:
-        reads = read_fasta(args.input_fasta_file, False)
-        
         if args.index_file:
             idx_to_seq, seq_to_idx = read_fasta(args.index_file, True)
         else:
             idx_to_seq, seq_to_idx = {}, {}
 
-        run_blat(args.output_path, args.input_fasta_file, args.adapter_file, blat)
-        adapter_dict = parse_blat(args.output_path, reads)
-        write_fasta_file(args, args.output_path, adapter_dict, reads, seq_to_idx, idx_to_seq)
+        if args.profile:
+            # no pool, the main process is sampled instead
+            profile_dir = args.output_path + 'post_profile/'
+            if not os.path.isdir(profile_dir):
+                os.mkdir(profile_dir)
+            run_profiled(profile_dir, stream_process, args, blat, idx_to_seq, seq_to_idx)
+            report_profile(merge_profiles(profile_dir, args.output_path + 'postprocessing_profile.folded'), sys.stderr)
+            shutil.rmtree(profile_dir)
+        else:
+            stream_process(args, blat, idx_to_seq, seq_to_idx)
 
 if __name__ == '__main__':
     args = parse_args()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import importlib.util
+
+ROOT = '/'.join(os.path.realpath(__file__).split('/')[:-2]) + '/'
+C3POA = ROOT + 'C3POa.py'
+# deterministic stand-ins of the golden checks, they don't behave like the real tools
+STAND_INS = ROOT + 'golden/tools/'
+# seconds between memory samples of the C3POa process tree
+SAMPLE_INTERVAL = 0.2
+
+def parse_args():
+    '''Parses arguments.'''
+    parser = argparse.ArgumentParser(description='Compares throughput per GB of process and thread mixes.',
+                                     add_help=True,
+                                     prefix_chars='-')
+    parser.add_argument('--reads', '-r', type=str, action='store',
+                        help='FASTQ file that contains the long R2C2 reads.')
+    parser.add_argument('--splint_file', '-s', type=str, action='store',
+                        help='Path to the splint FASTA file.')
+    parser.add_argument('--out_path', '-o', type=str, action='store', default=os.getcwd(),
+                        help='Directory where the benchmark runs will end up.')
+    parser.add_argument('--settings', type=str, action='store',
+                        default='-n 4;-n 2 --readThreads 2;-n 1 --readThreads 4',
+                        help='Semicolon separated list of process/thread settings to compare.')
+    parser.add_argument('--c3poa_args', type=str, action='store', default='',
+                        help='Extra arguments given to every C3POa run.')
+    return parser.parse_args()
+
+def stand_in_tools(c3poa_args):
+    '''
+    blat, racon and conk that a C3POa run with c3poa_args would not find, or
+    would take from the golden stand-ins. Throughput per GB only says something
+    about the real tools: the stand-in racon is a Python interpreter per read,
+    which favours threads that overlap waiting.
+    '''
+    progs = {'racon': 'racon', 'blat': 'blat'}
+    for option in ['-c', '--config']:
+        if option in c3poa_args:
+            for line in open(c3poa_args[c3poa_args.index(option) + 1]):
+                line = line.rstrip().split('\t')
+                if line[0] in progs and len(line) > 1:
+                    progs[line[0]] = line[1]
+    paths = {tool: shutil.which(path) for tool, path in progs.items()}
+    spec = importlib.util.find_spec('conk')
+    paths['conk'] = spec.origin if spec else None
+    return [tool for tool, path in sorted(paths.items())
+            if not path or os.path.realpath(path).startswith(STAND_INS)]
+
+def process_tree(pid):
+    '''pid and all of its descendants, from /proc'''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = open('/proc/' + entry + '/stat').read()
+        except OSError:
+            continue
+        # the command name can contain spaces, the parent pid follows its closing parenthesis
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo += children.get(p, [])
+    return tree
+
+def memory(pid):
+    '''
+    Proportional set size in bytes of a process tree, so interpreter pages
+    shared between forked processes are not counted once per process
+    '''
+    total = 0
+    for p in process_tree(pid):
+        try:
+            for line in open('/proc/' + str(p) + '/smaps_rollup'):
+                if line.startswith('Pss:'):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+def run(cmd):
+    '''Runs cmd and returns (seconds, peak memory in bytes)'''
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    peak = 0
+    while proc.poll() is None:
+        peak = max(peak, memory(proc.pid))
+        time.sleep(SAMPLE_INTERVAL)
+    if proc.returncode:
+        raise RuntimeError('Failed: ' + ' '.join(cmd))
+    return time.time() - start, peak
+
+def count_consensus(out_path):
+    reads = 0
+    for splint in os.listdir(out_path):
+        cons_file = out_path + splint + '/R2C2_Consensus.fasta'
+        if os.path.exists(cons_file):
+            reads += sum(1 for line in open(cons_file) if line.startswith('>'))
+    return reads
+
+def main(args):
+    if not args.out_path.endswith('/'):
+        args.out_path += '/'
+    if not os.path.exists(args.out_path):
+        os.mkdir(args.out_path)
+
+    assignments = ''
+    print('setting', 'seconds', 'reads', 'reads_per_second', 'peak_memory_gb', 'reads_per_second_per_gb', sep='\t')
+    for i, setting in enumerate(args.settings.split(';')):
+        run_path = args.out_path + 'setting_' + str(i) + '/'
+        if os.path.exists(run_path):
+            shutil.rmtree(run_path)
+        os.mkdir(run_path)
+        # reuse the splint alignments so only the consensus step differs
+        if assignments:
+            os.mkdir(run_path + 'tmp')
+            shutil.copy(assignments, run_path + 'tmp/splint_assignments.npz')
+        cmd = [sys.executable, C3POA, '-r', args.reads, '-s', args.splint_file, '-o', run_path] \
+              + setting.split() + args.c3poa_args.split()
+        elapsed, peak = run(cmd)
+        if not assignments:
+            assignments = run_path + 'tmp/splint_assignments.npz'
+        reads, peak_gb = count_consensus(run_path), peak / 1e9
+        print(setting, round(elapsed, 2), reads, round(reads / elapsed, 2), round(peak_gb, 3),
+              round(reads / elapsed / max(peak_gb, 1e-9), 2), sep='\t')
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.reads or not args.splint_file:
+        print('Reads (--reads/-r) and splint (--splint_file/-s) are required', file=sys.stderr)
+        sys.exit(1)
+    stand_ins = stand_in_tools(args.c3poa_args.split())
+    if stand_ins:
+        print('Real installs of blat, racon and conk are required, missing or stand-ins:',
+              ', '.join(stand_ins), file=sys.stderr)
+        sys.exit(1)
+    main(args)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import mappy as mm
+import editdistance as ld
+
+C3POA = '/'.join(os.path.realpath(__file__).split('/')[:-2]) + '/C3POa.py'
+
+def parse_args():
+    '''Parses arguments.'''
+    parser = argparse.ArgumentParser(description='Compares throughput and accuracy of racon polishing policies.',
+                                     add_help=True,
+                                     prefix_chars='-')
+    parser.add_argument('--reads', '-r', type=str, action='store',
+                        help='FASTQ file that contains the long R2C2 reads.')
+    parser.add_argument('--splint_file', '-s', type=str, action='store',
+                        help='Path to the splint FASTA file.')
+    parser.add_argument('--out_path', '-o', type=str, action='store', default=os.getcwd(),
+                        help='Directory where the benchmark runs will end up.')
+    parser.add_argument('--truth', '-t', type=str, action='store', default='',
+                        help='''Optional FASTA of true insert sequences named like the reads
+                                (simulated data). Without it, accuracy is measured against
+                                the always-polished consensus.''')
+    parser.add_argument('--policies', type=str, action='store',
+                        default='always;adaptive;adaptive --polish_repeats 3;never',
+                        help='Semicolon separated list of polishing settings to compare.')
+    parser.add_argument('--c3poa_args', type=str, action='store', default='-n 1',
+                        help='Extra arguments given to every C3POa run.')
+    return parser.parse_args()
+
+def read_consensus(out_path):
+    '''Returns read name: consensus for every splint directory in a run'''
+    cons = {}
+    for splint in os.listdir(out_path):
+        cons_file = out_path + splint + '/R2C2_Consensus.fasta'
+        if not os.path.exists(cons_file):
+            continue
+        for name, seq, _ in mm.fastx_read(cons_file, read_comment=False):
+            cons[name.rsplit('_', 4)[0]] = seq
+    return cons
+
+def identity(a, b):
+    return 1 - ld.eval(a, b) / max(len(a), len(b))
+
+def main(args):
+    if not args.out_path.endswith('/'):
+        args.out_path += '/'
+    if not os.path.exists(args.out_path):
+        os.mkdir(args.out_path)
+
+    truth = {}
+    if args.truth:
+        for name, seq, _ in mm.fastx_read(args.truth, read_comment=False):
+            truth[name] = seq
+
+    assignments, results = '', []
+    for i, policy in enumerate(args.policies.split(';')):
+        run_path = args.out_path + 'policy_' + str(i) + '/'
+        if os.path.exists(run_path):
+            shutil.rmtree(run_path)
+        os.mkdir(run_path)
+        # reuse the splint alignments so only the consensus step is timed differently
+        if assignments:
+            os.mkdir(run_path + 'tmp')
+            shutil.copy(assignments, run_path + 'tmp/splint_assignments.npz')
+        cmd = [sys.executable, C3POA, '-r', args.reads, '-s', args.splint_file, '-o', run_path,
+               '--polish'] + policy.split() + args.c3poa_args.split()
+        start = time.time()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.time() - start
+        if not assignments:
+            assignments = run_path + 'tmp/splint_assignments.npz'
+        results.append((policy, elapsed, read_consensus(run_path)))
+
+    reference = truth if truth else results[0][2]
+    print('policy', 'seconds', 'reads', 'reads_per_second', 'mean_identity', sep='\t')
+    for policy, elapsed, cons in results:
+        shared = [name for name in cons if name in reference]
+        mean_id = sum(identity(cons[name], reference[name]) for name in shared) / max(len(shared), 1)
+        print(policy, round(elapsed, 2), len(cons), round(len(cons) / elapsed, 2),
+              round(mean_id, 4), sep='\t')
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.reads or not args.splint_file:
+        print('Reads (--reads/-r) and splint (--splint_file/-s) are required', file=sys.stderr)
+        sys.exit(1)
+    main(args)
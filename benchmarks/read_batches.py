@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import argparse
+from hybrid_threads import C3POA, run
+
+def parse_args():
+    '''Parses arguments.'''
+    parser = argparse.ArgumentParser(description='Compares shared memory and pickled read batches.',
+                                     add_help=True,
+                                     prefix_chars='-')
+    parser.add_argument('--reads', '-r', type=str, action='store',
+                        help='FASTQ file that contains the long R2C2 reads.')
+    parser.add_argument('--splint_file', '-s', type=str, action='store',
+                        help='Path to the splint FASTA file.')
+    parser.add_argument('--out_path', '-o', type=str, action='store', default=os.getcwd(),
+                        help='Directory where the benchmark runs will end up.')
+    parser.add_argument('--threads', type=str, action='store', default='8,16,32',
+                        help='Comma separated --numThreads settings to compare both batch formats at.')
+    parser.add_argument('--c3poa_args', type=str, action='store', default='',
+                        help='Extra arguments given to every C3POa run.')
+    return parser.parse_args()
+
+def parent_usage(out_path):
+    '''Parent CPU seconds and peak RSS in MB from c3poa.log'''
+    cpu, rss = 0, 0
+    for line in open(out_path + 'c3poa.log'):
+        if line.startswith('Parent CPU seconds:'):
+            cpu = float(line.split(':')[1])
+        elif line.startswith('Parent peak RSS (MB):'):
+            rss = float(line.split(':')[1])
+    return cpu, rss
+
+def main(args):
+    if not args.out_path.endswith('/'):
+        args.out_path += '/'
+    if not os.path.exists(args.out_path):
+        os.mkdir(args.out_path)
+
+    assignments = ''
+    print('threads', 'read_batches', 'seconds', 'parent_cpu', 'parent_peak_rss_mb', 'tree_peak_pss_gb', sep='\t')
+    for threads in args.threads.split(','):
+        for batches in ['pickle', 'shared_memory']:
+            run_path = args.out_path + 'n' + threads + '_' + batches + '/'
+            if os.path.exists(run_path):
+                shutil.rmtree(run_path)
+            os.mkdir(run_path)
+            # reuse the splint alignments so only the consensus step differs
+            if assignments:
+                os.mkdir(run_path + 'tmp')
+                shutil.copy(assignments, run_path + 'tmp/splint_assignments.npz')
+            cmd = [sys.executable, C3POA, '-r', args.reads, '-s', args.splint_file, '-o', run_path,
+                   '-n', threads, '--read_batches', batches] + args.c3poa_args.split()
+            elapsed, peak = run(cmd)
+            if not assignments:
+                assignments = run_path + 'tmp/splint_assignments.npz'
+            cpu, rss = parent_usage(run_path)
+            print(threads, batches, round(elapsed, 2), cpu, rss, round(peak / 1e9, 3), sep='\t')
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.reads or not args.splint_file:
+        print('Reads (--reads/-r) and splint (--splint_file/-s) are required', file=sys.stderr)
+        sys.exit(1)
+    main(args)
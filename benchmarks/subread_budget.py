@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import mappy as mm
+from polish_policy import C3POA, read_consensus, identity
+
+def parse_args():
+    '''Parses arguments.'''
+    parser = argparse.ArgumentParser(description='Compares throughput and accuracy of subread budgets.',
+                                     add_help=True,
+                                     prefix_chars='-')
+    parser.add_argument('--reads', '-r', type=str, action='store',
+                        help='FASTQ file that contains the long R2C2 reads.')
+    parser.add_argument('--splint_file', '-s', type=str, action='store',
+                        help='Path to the splint FASTA file.')
+    parser.add_argument('--out_path', '-o', type=str, action='store', default=os.getcwd(),
+                        help='Directory where the benchmark runs will end up.')
+    parser.add_argument('--truth', '-t', type=str, action='store', default='',
+                        help='''Optional FASTA of true insert sequences named like the reads
+                                (simulated data). Without it, accuracy is measured against
+                                the run without a budget.''')
+    parser.add_argument('--budgets', type=str, action='store',
+                        default='0;8;5;3;5 --extra_subreads drop;3 --extra_subreads drop',
+                        help='''Semicolon separated list of --max_subreads settings to compare.
+                                The first one is the reference without --truth.''')
+    parser.add_argument('--c3poa_args', type=str, action='store', default='-n 1',
+                        help='Extra arguments given to every C3POa run.')
+    return parser.parse_args()
+
+def subreads_used(out_path):
+    '''Returns read name: subreads used from the polishing paths of a run'''
+    used = {}
+    for splint in os.listdir(out_path):
+        paths_file = out_path + splint + '/R2C2_Polish_Paths.tsv'
+        if not os.path.exists(paths_file):
+            continue
+        for line in open(paths_file):
+            line = line.rstrip().split('\t')
+            used[line[0]] = int(line[3])
+    return used
+
+def main(args):
+    if not args.out_path.endswith('/'):
+        args.out_path += '/'
+    if not os.path.exists(args.out_path):
+        os.mkdir(args.out_path)
+
+    truth = {}
+    if args.truth:
+        for name, seq, _ in mm.fastx_read(args.truth, read_comment=False):
+            truth[name] = seq
+
+    assignments, results = '', []
+    for i, budget in enumerate(args.budgets.split(';')):
+        run_path = args.out_path + 'budget_' + str(i) + '/'
+        if os.path.exists(run_path):
+            shutil.rmtree(run_path)
+        os.mkdir(run_path)
+        # reuse the splint alignments so only the consensus step is timed differently
+        if assignments:
+            os.mkdir(run_path + 'tmp')
+            shutil.copy(assignments, run_path + 'tmp/splint_assignments.npz')
+        cmd = [sys.executable, C3POA, '-r', args.reads, '-s', args.splint_file, '-o', run_path,
+               '--max_subreads'] + budget.split() + args.c3poa_args.split()
+        start = time.time()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.time() - start
+        if not assignments:
+            assignments = run_path + 'tmp/splint_assignments.npz'
+        results.append((budget, elapsed, read_consensus(run_path), subreads_used(run_path)))
+
+    reference = truth if truth else results[0][2]
+    print('budget', 'seconds', 'reads', 'reads_per_second', 'mean_identity', 'mean_subreads_used', sep='\t')
+    for budget, elapsed, cons, used in results:
+        shared = [name for name in cons if name in reference]
+        mean_id = sum(identity(cons[name], reference[name]) for name in shared) / max(len(shared), 1)
+        mean_used = sum(used.get(name, 0) for name in cons) / max(len(cons), 1)
+        print(budget, round(elapsed, 2), len(cons), round(len(cons) / elapsed, 2),
+              round(mean_id, 4), round(mean_used, 2), sep='\t')
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.reads or not args.splint_file:
+        print('Reads (--reads/-r) and splint (--splint_file/-s) are required', file=sys.stderr)
+        sys.exit(1)
+    main(args)
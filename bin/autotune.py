@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import math
+import time
+import shutil
+import resource
+import argparse
+import multiprocessing as mp
+from preprocess import process, assign_splints
+
+# ru_maxrss is in kilobytes on linux and in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+# copies of a group's reads held by the parent while it waits in the pool's
+# queue (the read list and its pickle or shared memory block) and by the
+# worker processing it, an upper bound for shared memory batches
+PARENT_COPIES, WORKER_COPIES = 2, 1
+# python object overhead of a (name, seq, qual) tuple on top of its characters
+READ_OVERHEAD = 200
+# a group should take at least this many times the cost of starting its worker
+MIN_SPAWN_RATIO = 20
+# and every worker should get at least this many groups so they finish together
+GROUPS_PER_WORKER = 4
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def available_memory():
+    '''MemAvailable in bytes, or all physical memory if /proc/meminfo is missing'''
+    if os.path.exists('/proc/meminfo'):
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def timed_call(function, args, submitted):
+    '''Runs function(*args) in a pool worker and measures it'''
+    started = time.time()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    function(*args)
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'spawn': started - submitted,
+        'cpu': cpu_seconds(self_after) - cpu_seconds(self_before),
+        'children_cpu': cpu_seconds(children_after) - cpu_seconds(children_before),
+        'start_rss': start_rss,
+        'peak_rss': self_after.ru_maxrss * MAXRSS_UNIT,
+        'children_rss': children_after.ru_maxrss * MAXRSS_UNIT
+    }
+
+def calibrate(args, sample, splint_dict, blat, racon, analyze):
+    '''
+    Runs BLAT and consensus calling on the sample reads in a throwaway output
+    directory and returns per read CPU seconds and memory of both stages.
+    '''
+    tune_dir = args.out_path + 'tmp/autotune/'
+    if os.path.isdir(tune_dir):
+        shutil.rmtree(tune_dir)
+    os.makedirs(tune_dir + 'tmp/')
+    tune_args = argparse.Namespace(**vars(args))
+    tune_args.out_path, tune_args.cache, tune_args.sweep = tune_dir, '', ''
+    sample_bytes = sum(len(name) + len(seq) + len(qual) + READ_OVERHEAD for name, seq, qual in sample)
+
+    # blat runs as a direct child here, so the children usage is blat alone
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    best, adapters = process(tune_args, sample, blat, 'autotune')
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    blat_cpu = cpu_seconds(children_after) - cpu_seconds(children_before)
+    blat_rss = children_after.ru_maxrss * MAXRSS_UNIT
+    sample_adapters = {name: [[None, 1, None]] for name, seq, qual in sample}
+    adapter_dict, adapter_set, no_splint = assign_splints(sample_adapters, best, adapters)
+    for adapter in adapter_set:
+        os.mkdir(tune_dir + adapter)
+
+    # consensus calling runs in a pool worker like it does for real
+    pool = mp.Pool(1, maxtasksperchild=1)
+    worker = pool.apply(timed_call, (analyze, (tune_args, sample, splint_dict, adapter_dict,
+                                               adapter_set, 1, racon), time.time()))
+    pool.close()
+    pool.join()
+    shutil.rmtree(tune_dir)
+
+    reads = len(sample)
+    return {
+        'reads': reads,
+        'read_bytes': sample_bytes / reads,
+        'blat_cpu': blat_cpu / reads,
+        'blat_rss': blat_rss,
+        'consensus_cpu': (worker['cpu'] + worker['children_cpu']) / reads,
+        'spawn': worker['spawn'],
+        # what a worker needs before it gets any reads and on top of them at its peak
+        'worker_rss': max(worker['start_rss'] - sample_bytes * WORKER_COPIES, 0),
+        'worker_peak': max(worker['peak_rss'] - worker['start_rss'], 0) + worker['children_rss'],
+        'parent_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+    }
+
+def plan(measured, num_reads, cores, max_memory):
+    '''
+    Picks pool sizes, group size and in-flight depth for the measured costs.
+    Consensus workers are the largest count whose fixed memory plus at least
+    a minimal group fits in max_memory. Groups are as large as load balancing
+    allows, but at least big enough to amortise starting their worker.
+    '''
+    budget = max_memory - measured['parent_rss']
+    worker_fixed = measured['worker_rss'] + measured['worker_peak']
+    per_read = max(measured['consensus_cpu'], 1e-6)
+    min_group = math.ceil(MIN_SPAWN_RATIO * measured['spawn'] / per_read)
+
+    workers, group_size, in_flight = 1, 1, 1
+    for workers in range(cores, 0, -1):
+        in_flight = 2 * workers
+        # every group in flight waits in the parent, every running one is in a worker
+        group_bytes = measured['read_bytes'] * (PARENT_COPIES * in_flight + WORKER_COPIES * workers)
+        memory_group = (budget - workers * worker_fixed) // group_bytes
+        balance_group = math.ceil(num_reads / (GROUPS_PER_WORKER * workers))
+        # load balance unless that makes groups too small to pay for their worker
+        group_size = max(balance_group, min(min_group, math.ceil(num_reads / workers)))
+        group_size = max(min(group_size, memory_group), 1)
+        if memory_group >= min(min_group, balance_group) or workers == 1:
+            break
+
+    # blat is cheap on memory, its workers are a spawned interpreter running blat
+    blat_fixed = measured['worker_rss'] + measured['blat_rss']
+    blat_procs = int(max(min(cores, budget // max(blat_fixed, 1)), 1))
+
+    groups = math.ceil(num_reads / group_size)
+    blat_time = measured['blat_cpu'] * num_reads / blat_procs + measured['spawn']
+    consensus_time = (per_read * num_reads + measured['spawn'] * groups) / min(workers, groups)
+    return {
+        'numThreads': workers,
+        'groupSize': group_size,
+        'inFlight': in_flight,
+        'blatProcs': blat_procs,
+        'projected_blat': blat_time,
+        'projected_consensus': consensus_time,
+        'projected_memory': measured['parent_rss'] + workers * worker_fixed
+                            + group_size * group_bytes
+    }
+
+def autotune(args, sample, splint_dict, num_reads, blat, racon, analyze):
+    '''Calibrates on the sample reads and sets the parallelism arguments in place'''
+    cores = available_cores()
+    max_memory = args.max_memory * 1000000 if args.max_memory else available_memory()
+    print('Calibrating on', len(sample), 'reads', file=sys.stderr)
+    measured = calibrate(args, sample, splint_dict, blat, racon, analyze)
+    tuned = plan(measured, num_reads, cores, max_memory)
+    args.numThreads = tuned['numThreads']
+    args.groupSize = tuned['groupSize']
+    args.inFlight = tuned['inFlight']
+    args.blatProcs = tuned['blatProcs']
+    # blat chunks are split evenly over its processes
+    args.blatThreads = True
+    tuned['cores'], tuned['max_memory'] = cores, max_memory
+    return measured, tuned
+
+def report(measured, tuned, fh):
+    print('Autotune sample reads:', measured['reads'], file=fh)
+    print('Autotune blat CPU ms/read:', round(measured['blat_cpu'] * 1000, 3), file=fh)
+    print('Autotune consensus CPU ms/read:', round(measured['consensus_cpu'] * 1000, 3), file=fh)
+    print('Autotune worker start (s):', round(measured['spawn'], 2), file=fh)
+    print('Autotune worker memory (MB):', round((measured['worker_rss'] + measured['worker_peak']) / 1e6, 1), file=fh)
+    print('Autotune cores / memory budget (MB):', tuned['cores'], '/', round(tuned['max_memory'] / 1e6), file=fh)
+    print('Autotune blat processes:', tuned['blatProcs'], file=fh)
+    print('Autotune consensus processes:', tuned['numThreads'], file=fh)
+    print('Autotune group size:', tuned['groupSize'], file=fh)
+    print('Autotune groups in flight:', tuned['inFlight'], file=fh)
+    print('Autotune projected peak memory (MB):', round(tuned['projected_memory'] / 1e6), file=fh)
+    total = tuned['projected_blat'] + tuned['projected_consensus']
+    print('Autotune projected runtime (min): {:.1f} (blat {:.1f}, consensus {:.1f})'.format(
+          total / 60, tuned['projected_blat'] / 60, tuned['projected_consensus'] / 60), file=fh)
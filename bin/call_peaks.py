@@ -3,14 +3,77 @@
 
 from savitzky_golay import savitzky_golay
 from scipy.signal import find_peaks
+from conk import conk
 import numpy as np
 
-def call_peaks(scores, min_dist, iters, window, order):
-    peaks = []
+def smooth_scores(scores, iters, window, order):
     for i in range(iters):
         scores = savitzky_golay(scores, window, order, deriv=0, rate=1)
+    return scores
+
+def pick_peaks(scores, min_dist):
+    peaks = []
     med_score = np.median(scores)
     if max(scores) < 6 * med_score:
         return peaks
     peaks, _ = find_peaks(scores, distance=min_dist, height=med_score * 3)
     return peaks
+
+def call_peaks(scores, min_dist, iters, window, order):
+    return pick_peaks(smooth_scores(scores, iters, window, order), min_dist)
+
+def place_peaks(peaks, splint_len, seq_len):
+    '''Moves peaks to the middle of the splint and drops those past the read'''
+    if not list(peaks):
+        return []
+    peaks = list(peaks + splint_len // 2)
+    for i in range(len(peaks) - 1, -1, -1):
+        if peaks[i] >= seq_len:
+            del peaks[i]
+    return [int(x) for x in peaks]
+
+def read_peaks(seq, splint, mdistcutoff, penalty, iters, window, order):
+    '''Returns the splint positions in a read'''
+    scores = conk.conk(splint, seq, penalty)
+    peaks = call_peaks(scores, mdistcutoff, iters, window, order)
+    return place_peaks(peaks, len(splint), len(seq))
+
+def rounding(x, base):
+    '''Rounds to the nearest base, we use 50'''  #round to nearest 50, e.g. 0, 50, 100, 150, etc (e.g. 59 becomes 50)
+    return int(base * round(float(x) / base))
+
+def subread_bounds(seq_len, peaks, tolerance=0.2):
+    '''
+    Returns the [start, end) coordinates of the subreads between splint
+    positions and of the dangling ends before the first and after the last.
+    Subreads more than tolerance away from the median length are left out.
+    '''
+    # check for outliers in subread length
+    bounds, dangling_bounds = [], []
+    if len(peaks) > 1:
+        subread_lens = np.diff(peaks)
+        subread_lens = [rounding(x, 50) for x in subread_lens]
+        median_subread_len = np.median(subread_lens)
+        for i in range(len(subread_lens)):
+            if median_subread_len*(1 - tolerance) <= subread_lens[i] <= median_subread_len*(1 + tolerance):
+                bounds.append((peaks[i], peaks[i+1]))
+        if peaks[0] > 100:
+            dangling_bounds.append((0, peaks[0]))
+        if seq_len - peaks[-1] > 100:
+            dangling_bounds.append((peaks[-1], seq_len))
+    else:
+        dangling_bounds.append((0, peaks[0]))
+        dangling_bounds.append((peaks[0], seq_len))
+    return bounds, dangling_bounds
+
+def split_read(seq, qual, peaks, tolerance=0.2):
+    '''
+    Cuts a read into subreads at the splint positions.
+    Subreads more than tolerance away from the median length are left out.
+    '''
+    bounds, dangling_bounds = subread_bounds(len(seq), peaks, tolerance)
+    subreads = [seq[start:end] for start, end in bounds]
+    qual_subreads = [qual[start:end] for start, end in bounds]
+    dangling_subreads = [seq[start:end] for start, end in dangling_bounds]
+    qual_dangling_subreads = [qual[start:end] for start, end in dangling_bounds]
+    return subreads, qual_subreads, dangling_subreads, qual_dangling_subreads
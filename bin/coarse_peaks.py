@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import threading
+from scipy.signal import find_peaks
+from conk import conk
+from overlap import kmer_codes, kmer_table
+from call_peaks import smooth_scores, place_peaks, read_peaks
+
+# seeds between the splint and the read
+K = 9
+# per thread, like overlap.TABLES
+TABLES = threading.local()
+# splint start estimates are binned, a bin with this many seeds (with its
+# neighbours) is a candidate splint copy
+BIN = 64
+MIN_SEEDS = 4
+# background windows that stand in for the score median of the whole read
+BACKGROUND_WINDOWS = 4
+BACKGROUND_LEN = 2000
+# above this fraction of the read in windows, scoring the whole read is as cheap
+MAX_WINDOW_FRACTION = 0.5
+
+def candidate_starts(seq, splint):
+    '''Start positions (binned) of likely splint copies from shared k-mers'''
+    splint_codes, read_codes = kmer_codes(splint, K), kmer_codes(seq, K)
+    if not len(splint_codes) or not len(read_codes):
+        return []
+    table = kmer_table(TABLES, K)
+    valid = splint_codes >= 0
+    # reversed so repeated splint k-mers keep their first offset
+    table[splint_codes[valid][::-1]] = np.nonzero(valid)[0][::-1]
+    offsets = table[np.where(read_codes >= 0, read_codes, 0)]
+    offsets[read_codes < 0] = -1
+    table[splint_codes[valid]] = -1
+    read_pos = np.nonzero(offsets >= 0)[0]
+    starts = read_pos - offsets[read_pos]
+    starts = starts[starts > -len(splint)] + len(splint)
+    if not len(starts):
+        return []
+    seeds = np.bincount(starts // BIN)
+    # indels move the start estimate across bin borders
+    seeds = seeds + np.concatenate(([0], seeds[:-1])) + np.concatenate((seeds[1:], [0]))
+    return [int(b) * BIN - len(splint) for b in np.nonzero(seeds >= MIN_SEEDS)[0]]
+
+def merge_windows(starts, pad, length, seq_len):
+    '''Merges [start - pad, start + length + pad) windows, clipped to the read'''
+    windows = []
+    for start in starts:
+        window_start, window_end = max(start - pad, 0), min(start + length + pad, seq_len)
+        if windows and window_start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], window_end)
+        else:
+            windows.append([window_start, window_end])
+    return windows
+
+def window_scores(seq, splint, penalty, start, end, pad, iters, window, order):
+    '''
+    Smoothed conk scores of seq[start:end] and the range of them that matches
+    scoring the whole read. Within pad of a cut end of the window the alignment
+    or smoothing context is missing.
+    '''
+    scores = smooth_scores(conk.conk(splint, seq[start:end], penalty), iters, window, order)
+    keep_start = 0 if start == 0 else pad
+    keep_end = len(scores) if end == len(seq) else len(scores) - pad
+    return scores, keep_start, keep_end
+
+def suppress(positions, heights, min_dist):
+    '''
+    Keeps the highest peaks that are at least min_dist apart, the way
+    find_peaks(distance=min_dist) does over the whole read
+    '''
+    keep = np.ones(len(positions), dtype=bool)
+    for i in np.argsort(heights)[::-1]:
+        if not keep[i]:
+            continue
+        close = np.abs(positions - positions[i]) < min_dist
+        close[i] = False
+        keep[close] = False
+    return positions[keep]
+
+def coarse_read_peaks(seq, splint, mdistcutoff, penalty, iters, window, order):
+    '''
+    Returns the splint positions in a read like read_peaks, but conk and the
+    smoothing only run in windows around k-mer candidates for splint copies
+    and in a few background windows for the score median.
+    '''
+    seq_len, splint_len = len(seq), len(splint)
+    # enough context for a splint alignment plus the smoothing passes
+    pad = splint_len + iters * window
+    windows = merge_windows(candidate_starts(seq, splint), pad, splint_len, seq_len)
+    covered = sum(end - start for start, end in windows)
+    if not windows or covered + BACKGROUND_WINDOWS * (BACKGROUND_LEN + 2 * pad) > MAX_WINDOW_FRACTION * seq_len:
+        return read_peaks(seq, splint, mdistcutoff, penalty, iters, window, order)
+
+    # background windows evenly spread over the gaps between candidates
+    background, background_len = [], BACKGROUND_LEN + 2 * pad
+    for i in range(BACKGROUND_WINDOWS):
+        start = (i + 1) * seq_len // (BACKGROUND_WINDOWS + 1) - background_len // 2
+        for window_start, window_end in windows:
+            if start < window_end and start + background_len > window_start:
+                start = window_end
+        if start + background_len <= seq_len:
+            scores, keep_start, keep_end = window_scores(seq, splint, penalty, start, start + background_len,
+                                                         pad, iters, window, order)
+            background.append(scores[keep_start:keep_end])
+    if not background:
+        return read_peaks(seq, splint, mdistcutoff, penalty, iters, window, order)
+    background = np.concatenate(background)
+    med_score = np.median(background)
+
+    positions, heights, max_score = [], [], background.max()
+    for start, end in windows:
+        scores, keep_start, keep_end = window_scores(seq, splint, penalty, start, end, pad, iters, window, order)
+        if keep_end <= keep_start:
+            continue
+        max_score = max(max_score, scores[keep_start:keep_end].max())
+        # local maxima without the distance filter, that has to see every window
+        local, props = find_peaks(scores, height=med_score * 3)
+        kept = (local >= keep_start) & (local < keep_end)
+        positions += list(local[kept] + start)
+        heights += list(props['peak_heights'][kept])
+    if max_score < 6 * med_score or not positions:
+        return []
+    peaks = suppress(np.array(positions), np.array(heights), mdistcutoff)
+    return place_peaks(np.sort(peaks), splint_len, seq_len)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import time
+import shutil
+import resource
+from tqdm import tqdm
+
+# bytes asked of the kernel per copy call, and buffer size when compressing
+CHUNK = 64 * 1024 * 1024
+
+def copy_range(src_fd, dst_fd, offset, size):
+    '''Copies src from offset to size onto the position of dst without leaving the kernel'''
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dst_fd, min(CHUNK, size - offset), offset)
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+def send_file(src_fd, dst_fd, offset, size):
+    '''sendfile to a regular file, for kernels or filesystems without copy_file_range'''
+    while offset < size:
+        copied = os.sendfile(dst_fd, src_fd, offset, min(CHUNK, size - offset))
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+KERNEL_COPIES = [copy for name, copy in [('copy_file_range', copy_range), ('sendfile', send_file)]
+                 if hasattr(os, name)]
+
+def append_file(path, dst):
+    '''
+    Appends the file at path to dst, an unbuffered binary file. Falls back to the
+    next kernel copy when one is refused (EXDEV, ENOSYS, EINVAL, ...) and to a
+    buffered copy of whatever is left when none of them work.
+    Returns whether the whole file was copied by the kernel.
+    '''
+    size = os.path.getsize(path)
+    start, done = dst.tell(), 0
+    with open(path, 'rb') as src:
+        for copy in KERNEL_COPIES:
+            try:
+                done = copy(src.fileno(), dst.fileno(), done, size)
+            except OSError:
+                # both copies write at the position of dst, it holds what got
+                # through before the failure
+                done = dst.tell() - start
+                continue
+            if done == size:
+                return True
+        src.seek(done)
+        shutil.copyfileobj(src, dst, CHUNK)
+    return False
+
+def merge_files(paths, output, compress, description=''):
+    '''
+    Concatenates paths into output (output.gz when compressing) and returns
+    [files, bytes, seconds, cpu seconds, files copied in the kernel].
+    Compressed output goes through a large buffer, everything else is
+    appended by the kernel without passing through python.
+    '''
+    start, usage = time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF)
+    files, size, kernel = 0, 0, 0
+    if compress:
+        output += '.gz'
+        final_fh = gzip.open(output, 'wb+')
+    else:
+        final_fh = open(output, 'wb+', buffering=0)
+    for f in tqdm(paths, desc=description) if description else paths:
+        files += 1
+        size += os.path.getsize(f)
+        if compress:
+            with open(f, 'rb') as fh:
+                shutil.copyfileobj(fh, final_fh, CHUNK)
+        else:
+            kernel += append_file(f, final_fh)
+    final_fh.close()
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = end.ru_utime - usage.ru_utime + end.ru_stime - usage.ru_stime
+    return [files, size, time.perf_counter() - start, cpu, kernel]
+
+def add_merge(total, merged):
+    '''Sums merge_files results into total'''
+    for i, value in enumerate(merged):
+        total[i] += value
+
+def report_merge(total, fh):
+    files, size, seconds, cpu, kernel = total
+    print('Output merge:', files, 'files,', round(size / 1e6, 1), 'MB in', round(seconds, 2),
+          'seconds, CPU', round(cpu, 2), 'seconds,', kernel, 'files copied in the kernel', file=fh)
@@ -1,133 +1,363 @@
 #!/usr/bin/env python3
 # Roger Volden
 
+import os
 import pyabpoa as poa
 import mappy as mm
-import os
+import numpy as np
+import tempfile
 import subprocess
+import threading
 from consensus import pairwise_consensus
+from overlap import find_overlap
+from profiler import waiting
+from result_cache import digest
+
+# gap character of abPOA MSA rows
+GAP = ord('-')
+# abPOA aligners are made once per thread (read threads of a worker) and reused
+ALIGNERS = threading.local()
+
+def msa_aligner():
+    '''The calling thread's abPOA aligner'''
+    if not hasattr(ALIGNERS, 'aligner'):
+        ALIGNERS.aligner = poa.msa_aligner(match=5)
+    return ALIGNERS.aligner
+
+# metadata calls on racon's scratch directories and file slots in this process,
+# a slot is created by the first racon run of its directory and truncated after that
+RACON_FILE_OPS = dict.fromkeys(['mkdir', 'create', 'truncate', 'unlink', 'rmdir'], 0)
+SLOTS = set()
+FILE_OPS_LOCK = threading.Lock()
+
+def count_file_op(op):
+    with FILE_OPS_LOCK:
+        RACON_FILE_OPS[op] += 1
+
+def make_scratch(parent, prefix):
+    '''New scratch directory for racon's file slots'''
+    scratch_dir = tempfile.mkdtemp(prefix=prefix, dir=parent) + '/'
+    count_file_op('mkdir')
+    return scratch_dir
+
+def open_slot(path):
+    '''Opens a racon file slot for writing, which creates or truncates it'''
+    with FILE_OPS_LOCK:
+        RACON_FILE_OPS['truncate' if path in SLOTS else 'create'] += 1
+        SLOTS.add(path)
+    return open(path, 'w+')
+
+def remove_scratch(scratch_dir):
+    '''Removes a scratch directory (and the ones of its read threads) with their slots'''
+    for root, dirs, files in os.walk(scratch_dir, topdown=False):
+        for f in files:
+            os.unlink(os.path.join(root, f))
+            count_file_op('unlink')
+        os.rmdir(root)
+        count_file_op('rmdir')
+    with FILE_OPS_LOCK:
+        SLOTS.difference_update([path for path in SLOTS if path.startswith(scratch_dir)])
+
+def racon_file_ops():
+    '''The metadata calls counted since the last call, the counters start over'''
+    with FILE_OPS_LOCK:
+        ops = dict(RACON_FILE_OPS)
+        for op in RACON_FILE_OPS:
+            RACON_FILE_OPS[op] = 0
+    return ops
+
+def mean_quality(quals):
+    '''Average phred quality over a list of quality strings'''
+    return np.frombuffer(''.join(quals).encode(), dtype=np.uint8).mean() - 33
 
-def determine_consensus(args, read, subreads, sub_qual, dangling_subreads, qual_dangling_subreads, racon, tmp_dir, subread_file):
+def msa_agreement(msa_seq, repeats):
+    '''Fraction of MSA columns where every subread has the same base'''
+    columns = list(zip(*msa_seq[:repeats]))
+    if not columns:
+        return 0
+    agree = sum(1 for col in columns if col[0] != '-' and col.count(col[0]) == repeats)
+    return agree / len(columns)
+
+def should_polish(args, repeats, sub_qual, agreement):
+    '''Decides whether racon should polish the abPOA consensus of a read'''
+    if args.polish == 'always':
+        return True
+    if args.polish == 'never':
+        return False
+    # adaptive: skip racon once any enabled criterion says the consensus is good enough
+    if repeats >= args.polish_repeats:
+        return False
+    if args.polish_qual and mean_quality(sub_qual) >= args.polish_qual:
+        return False
+    if args.polish_agreement and agreement >= args.polish_agreement:
+        return False
+    return True
+
+def subread_budget(args, repeats):
+    '''
+    How many subreads abPOA aligns, 0 for all of them. Reads over
+    --guard_subreads are capped at that many before abPOA sees them.
+    '''
+    budget = args.max_subreads
+    if args.guard_subreads and repeats > args.guard_subreads:
+        budget = min(budget, args.guard_subreads) if budget else args.guard_subreads
+    return budget
+
+def select_subreads(args, subreads, sub_qual):
+    '''
+    Indexes of the subreads that go into abPOA and of the ones that only help
+    polishing (none with --extra_subreads drop). Without a budget, or within it,
+    every subread is used. Subreads are ranked by mean quality, scaled down by
+    how far their length is from the median subread length.
+    '''
+    repeats = len(subreads)
+    budget = subread_budget(args, repeats)
+    if not budget or repeats <= budget:
+        return list(range(repeats)), []
+    median_len = max(np.median([len(x) for x in subreads]), 1)
+    scores = [mean_quality([q]) * (1 - abs(len(x) - median_len) / median_len)
+              for x, q in zip(subreads, sub_qual)]
+    ranked = sorted(range(repeats), key=lambda i: scores[i], reverse=True)
+    # keep read order, abPOA's result depends on the order of its input
+    selected = sorted(ranked[:budget])
+    extra = sorted(ranked[budget:]) if args.extra_subreads == 'polish' else []
+    return selected, extra
+
+def write_subreads(fh, name, subreads, sub_qual, dangling_subreads, qual_dangling_subreads, coords=None):
+    '''
+    Subreads are name_1..name_n, the dangling ends name_0 and name_n+1.
+    With coords (the [start, end) bounds of the subreads and of the dangling
+    ends in the read) only read name, index, start and end are written.
+    '''
+    repeats = len(subreads)
+    if coords:
+        for i, (start, end) in enumerate(coords[0]):
+            print(name, i+1, start, end, sep='\t', file=fh)
+        for j, (start, end) in enumerate(coords[1]):
+            print(name, 0 if j == 0 else repeats + 1, start, end, sep='\t', file=fh)
+        return
+    for i in range(repeats):
+        print('@{name}\n{sub}\n+\n{q}'.format(name=name + '_' + str(i+1), sub=subreads[i], q=sub_qual[i]), file=fh)
+    for j in range(len(dangling_subreads)):
+        qname = name + '_' + str(0 if j == 0 else repeats + 1)
+        print('@{name}\n{sub}\n+\n{q}'.format(name=qname, sub=dangling_subreads[j], q=qual_dangling_subreads[j]), file=fh)
+
+def determine_consensus(args, read, subreads, sub_qual, dangling_subreads, qual_dangling_subreads, racon, scratch_dir, subread_fh, cache=None, read_key='', bounds=None):
+    '''
+    bounds are the [start, end) coordinates of the subreads and dangling ends
+    in the read (subread_bounds), for --subread_output coords and msa overlaps
+    '''
     name, seq, qual = read[0], read[1], read[2]
     repeats = len(subreads)
+    coords = bounds if args.subread_output == 'coords' else None
 
     if repeats == 0 and args.zero:
         if len(dangling_subreads) == 2:
-            final_cons = zero_repeats(name, seq, qual, dangling_subreads, qual_dangling_subreads, subread_file)
+            final_cons = cache.get('zero', read_key) if cache else None
+            if final_cons is None:
+                final_cons = zero_repeats(name, seq, qual, dangling_subreads, qual_dangling_subreads)
+                if cache:
+                    cache.put('zero', read_key, final_cons)
+            write_subreads(subread_fh, name, [], [], dangling_subreads, qual_dangling_subreads,
+                           ([], coords[1]) if coords else None)
             if final_cons and len(final_cons) >= args.mdistcutoff:
-                return final_cons, 0
+                return final_cons, 0, 'zero', 0
 
-    # subread is the master subread fastq for this group
-    subread_fh = open(subread_file, 'a+')
-    # overlap file is where the mappy alignment will go (req. by racon)
-    overlap_file = tmp_dir + '{name}_overlaps.paf'.format(name=name)
-    overlap_fh = open(overlap_file, 'w+')
-    # temporary subreads specific for the current read (req. by racon)
-    tmp_subread_file = tmp_dir + '{name}_subreads.fastq'.format(name=name)
-    tmp_subread_fh = open(tmp_subread_file, 'w+')
+    # with a subread budget (or over --guard_subreads) only the best subreads are aligned
+    selected, extra = select_subreads(args, subreads, sub_qual)
+    poa_subreads = [subreads[i] for i in selected]
+    poa_qual = [sub_qual[i] for i in selected]
+    used = len(selected)
 
     # align subreads together using abPOA
-    poa_aligner = poa.msa_aligner(match=5)
+    cached = cache.get('abpoa', read_key) if cache and used > 1 else None
+    msa = None
+    if cached is not None:
+        abpoa_cons, agreement = cached
+    else:
+        abpoa_cons, agreement, msa = abpoa_consensus(poa_subreads, poa_qual)
+        if cache and used > 1:
+            cache.put('abpoa', read_key, (abpoa_cons, agreement))
+    if not abpoa_cons:
+        return '', 0, 'failed', 0
+
+    write_subreads(subread_fh, name, subreads, sub_qual, dangling_subreads, qual_dangling_subreads, coords)
+    # reads with too many subreads for racon keep the abPOA consensus of their best ones
+    if args.guard_subreads and repeats > args.guard_subreads:
+        return abpoa_cons, repeats, 'abpoa', used
+    if not should_polish(args, used, poa_qual, agreement):
+        return abpoa_cons, repeats, 'abpoa', used
+
+    polish_subreads = sorted(selected + extra)
+    racon_key = digest(read_key, 'msa_overlaps') if args.racon_overlaps == 'msa' else read_key
+    final_cons = cache.get('racon', racon_key) if cache else None
+    if final_cons is None:
+        overlaps = None
+        if args.racon_overlaps == 'msa':
+            # MSA rows of the subreads that abPOA aligned, the others are mapped with mappy
+            rows = [selected.index(i) if msa and i in selected else None for i in polish_subreads]
+            overlaps = derived_overlaps(msa, rows, dangling_subreads, bounds[1] if bounds else None, len(abpoa_cons))
+        try:
+            final_cons = racon_polish(name, abpoa_cons,
+                                      [subreads[i] for i in polish_subreads], [sub_qual[i] for i in polish_subreads],
+                                      dangling_subreads, qual_dangling_subreads, racon, scratch_dir, overlaps,
+                                      timeout=args.guard_timeout or None)
+        except subprocess.TimeoutExpired:
+            return abpoa_cons, repeats, 'timeout', used
+        if cache:
+            cache.put('racon', racon_key, final_cons)
+    return final_cons, repeats, 'racon', used
+
+def abpoa_consensus(subreads, sub_qual):
+    '''
+    Returns the abPOA consensus of the subreads, how well they agree and the
+    MSA with the consensus as its last row (None for fewer than 3 subreads)
+    '''
+    repeats = len(subreads)
+    # abPOA raises on an empty list (zero repeat reads that could not be rescued)
+    if not repeats:
+        return '', 0, None
+    poa_aligner = msa_aligner()
+    agreement, msa = 0, None
     if repeats == 1:
         abpoa_cons = subreads[0]
     elif repeats == 2:
         res = poa_aligner.msa(subreads, out_cons=False, out_msa=True)
         if not res.msa_seq:
-            subread_fh.close()
-            overlap_fh.close()
-            tmp_subread_file.close()
-            os.system('rm {tmp_files}'.format(tmp_files=' '.join([tmp_subread_file, overlap_file])))
-            return '', 0
+            return '', 0, None
         abpoa_cons = pairwise_consensus(res.msa_seq, subreads, sub_qual)
+        agreement = msa_agreement(res.msa_seq, repeats)
     else:
         res = poa_aligner.msa(subreads, out_cons=True, out_msa=True)
         if not res.cons_seq:
-            os.system('rm {tmp_files}'.format(tmp_files=' '.join([tmp_subread_file, overlap_file])))
-            return '', 0
+            return '', 0, None
         abpoa_cons = res.cons_seq[0]
+        agreement = msa_agreement(res.msa_seq, repeats)
+        msa = res.msa_seq
+    return abpoa_cons, agreement, msa
+
+def msa_overlap(row, cons_row):
+    '''
+    PAF fields (q_st, q_en, strand, r_st, r_en, mlen, blen, mapq) of an MSA row
+    against the consensus row, None if they share no aligned column
+    '''
+    row, cons_row = np.frombuffer(row.encode(), dtype=np.uint8), np.frombuffer(cons_row.encode(), dtype=np.uint8)
+    q_base, r_base = row != GAP, cons_row != GAP
+    aligned = np.nonzero(q_base & r_base)[0]
+    if not len(aligned):
+        return None
+    first, last = aligned[0], aligned[-1] + 1
+    q_st, r_st = np.count_nonzero(q_base[:first]), np.count_nonzero(r_base[:first])
+    q_en = q_st + np.count_nonzero(q_base[first:last])
+    r_en = r_st + np.count_nonzero(r_base[first:last])
+    mlen = np.count_nonzero((row[first:last] == cons_row[first:last]) & q_base[first:last])
+    blen = np.count_nonzero(q_base[first:last] | r_base[first:last])
+    return int(q_st), int(q_en), '+', int(r_st), int(r_en), int(mlen), int(blen), 255
+
+def dangling_overlap(dangling_len, left, cons_len):
+    '''
+    PAF fields of a dangling end from where it sits in the read: the end before
+    the first splint is the end of an insert, the one after the last is its start.
+    Base matches are unknown, racon aligns within the range itself.
+    '''
+    span = min(dangling_len, cons_len)
+    if left:
+        return dangling_len - span, dangling_len, '+', cons_len - span, cons_len, span, span, 255
+    return 0, span, '+', 0, span, span, span, 255
+
+def derived_overlaps(msa, rows, dangling_subreads, dangling_bounds, cons_len):
+    '''
+    Racon overlaps of the polishing subreads (rows are their MSA rows, None if
+    abPOA did not align them) and of the dangling ends without mapping them.
+    None entries are left to mappy.
+    '''
+    overlaps = [msa_overlap(msa[row], msa[-1]) if row is not None else None for row in rows]
+    for j, dangling in enumerate(dangling_subreads):
+        if dangling_bounds:
+            overlaps.append(dangling_overlap(len(dangling), dangling_bounds[j][0] == 0, cons_len))
+        else:
+            overlaps.append(None)
+    return overlaps
+
+def racon_polish(name, abpoa_cons, subreads, sub_qual, dangling_subreads, qual_dangling_subreads, racon, scratch_dir, overlaps=None, timeout=None):
+    '''
+    Polishes the abPOA consensus with all of the subreads. overlaps has PAF
+    fields for the subreads and then the dangling ends, subreads without
+    (None, or no overlaps at all) are mapped to the consensus with mappy.
+    racon is killed after timeout seconds and subprocess.TimeoutExpired raised.
+    '''
+    repeats = len(subreads)
+    # racon's input and output files are fixed slots in the worker's scratch
+    # directory that get truncated for every read instead of created and removed
+    # overlap file is where the mappy alignment will go (req. by racon)
+    overlap_file = scratch_dir + 'overlaps.paf'
+    overlap_fh = open_slot(overlap_file)
+    # temporary subreads specific for the current read (req. by racon)
+    tmp_subread_file = scratch_dir + 'subreads.fastq'
+    tmp_subread_fh = open_slot(tmp_subread_file)
+    write_subreads(tmp_subread_fh, name, subreads, sub_qual, dangling_subreads, qual_dangling_subreads)
+    tmp_subread_fh.close()
 
     # have to write out the consensus seq because it's going to get polished by racon
-    abpoa_fasta = tmp_dir + '{name}_abpoa.fasta'.format(name=name)
-    abpoa_fasta_fh = open(abpoa_fasta, 'w+')
+    abpoa_fasta = scratch_dir + 'abpoa.fasta'
+    abpoa_fasta_fh = open_slot(abpoa_fasta)
     print('>{name}\n{seq}\n'.format(name=name, seq=abpoa_cons), file=abpoa_fasta_fh)
     abpoa_fasta_fh.close()
 
     # map each of the subreads to the poa consensus
-    mm_align = mm.Aligner(seq=abpoa_cons, preset='map-ont')
-    for i in range(repeats):
-        subread = subreads[i]
-        q = sub_qual[i]
-        qname = name + '_' + str(i+1)
-        print('@{name}\n{sub}\n+\n{q}'.format(name=qname, sub=subread, q=q), file=subread_fh)
-        print('@{name}\n{sub}\n+\n{q}'.format(name=qname, sub=subread, q=q), file=tmp_subread_fh)
-        for hit in mm_align.map(subread):
-            print("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format(
-                qname, str(len(subread)), hit.q_st, hit.q_en,
-                hit.strand, name, hit.ctg_len, hit.r_st,
-                hit.r_en, hit.mlen, hit.blen, hit.mapq), file=overlap_fh)
-
-    for j in range(len(dangling_subreads)):
-        subread = dangling_subreads[j]
-        q = qual_dangling_subreads[j]
-        if j == 0:
-            qname = name + '_' + str(j)
+    mm_align = None
+    qnames = [name + '_' + str(i+1) for i in range(repeats)]
+    qnames += [name + '_' + str(0 if j == 0 else repeats + 1) for j in range(len(dangling_subreads))]
+    if not overlaps:
+        overlaps = [None] * len(qnames)
+    for qname, subread, overlap in zip(qnames, subreads + dangling_subreads, overlaps):
+        if overlap:
+            hits = [overlap]
         else:
-            qname = name + '_' + str(i+2)
-        print('@{name}\n{sub}\n+\n{q}'.format(name=qname, sub=subread, q=q), file=subread_fh)
-        print('@{name}\n{sub}\n+\n{q}'.format(name=qname, sub=subread, q=q), file=tmp_subread_fh)
-        for hit in mm_align.map(subread):
+            # the index is only built if a subread has no derived overlap
+            if mm_align is None:
+                mm_align = mm.Aligner(seq=abpoa_cons, preset='map-ont')
+            hits = [(hit.q_st, hit.q_en, hit.strand, hit.r_st, hit.r_en, hit.mlen, hit.blen, hit.mapq)
+                    for hit in mm_align.map(subread)]
+        for q_st, q_en, strand, r_st, r_en, mlen, blen, mapq in hits:
             print("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format(
-                qname, str(len(subread)), hit.q_st, hit.q_en,
-                hit.strand, name, hit.ctg_len, hit.r_st,
-                hit.r_en, hit.mlen, hit.blen, hit.mapq), file=overlap_fh)
-    subread_fh.close()
+                qname, str(len(subread)), q_st, q_en,
+                strand, name, len(abpoa_cons), r_st,
+                r_en, mlen, blen, mapq), file=overlap_fh)
     overlap_fh.close()
-    tmp_subread_fh.close()
 
-    racon_cons_file = tmp_dir + '{name}_racon_cons.fasta'.format(name=name)
-    racon_cons_fh = open(racon_cons_file, 'w+')
-    racon_msgs_fh = open(tmp_dir + 'racon_messages.log', 'w+')
+    racon_cons_file = scratch_dir + 'racon_cons.fasta'
+    racon_cons_fh = open_slot(racon_cons_file)
+    racon_msgs_fh = open_slot(scratch_dir + 'racon_messages.log')
 
     # polish poa cons with the subreads
-    subprocess.run([racon, tmp_subread_file, overlap_file, abpoa_fasta, '-q', '5', '-t', '1'],
-                   stdout=racon_cons_fh, stderr=racon_msgs_fh)
-    racon_cons_fh.close()
-    racon_msgs_fh.close()
+    try:
+        with waiting('racon'):
+            subprocess.run([racon, tmp_subread_file, overlap_file, abpoa_fasta, '-q', '5', '-t', '1'],
+                           stdout=racon_cons_fh, stderr=racon_msgs_fh, timeout=timeout)
+    finally:
+        racon_cons_fh.close()
+        racon_msgs_fh.close()
 
     final_cons = ''
     for read in mm.fastx_read(racon_cons_file, read_comment=False):
         final_cons = read[1]
+    return final_cons
 
-    tmp_files = ' '.join([overlap_file, tmp_subread_file, abpoa_fasta, racon_cons_file])
-    os.system('rm {tmp_files}'.format(tmp_files=tmp_files))
-
-    return final_cons, repeats
-
-def zero_repeats(name, seq, qual, subreads, sub_qual, subread_file):
-    # subread is the master subread fastq for this group
-    subread_fh = open(subread_file, 'a+')
-    for i in range(len(subreads)):
-        print('@{name}\n{sub}\n+\n{q}'.format(name=name + '_' + str(i),
-                                              sub=subreads[i],
-                                              q=sub_qual[i]),
-                                              file=subread_fh)
-    subread_fh.close()
-
-    mappy_res = []
-    mm_align = mm.Aligner(seq=subreads[0], preset='map-ont', scoring=(20, 7, 10, 5))
-    for hit in mm_align.map(subreads[1]):
-        mappy_res = [hit.r_st, hit.r_en, hit.q_st, hit.q_en]
-    if not mappy_res:
+def zero_repeats(name, seq, qual, subreads, sub_qual):
+    # the end of the right half wraps around onto the start of the left half
+    overlap_res = find_overlap(subreads[0], subreads[1])
+    if not overlap_res:
         return ''
 
-    left = subreads[1][:mappy_res[2]]
-    right = subreads[0][mappy_res[1]:]
-    overlap_seq1 = subreads[0][mappy_res[0]:mappy_res[1]]
-    overlap_qual1 = sub_qual[0][mappy_res[0]:mappy_res[1]]
-    overlap_seq2 = subreads[1][mappy_res[2]:mappy_res[3]]
-    overlap_qual2 = sub_qual[1][mappy_res[2]:mappy_res[3]]
+    left = subreads[1][:overlap_res[2]]
+    right = subreads[0][overlap_res[1]:]
+    overlap_seq1 = subreads[0][overlap_res[0]:overlap_res[1]]
+    overlap_qual1 = sub_qual[0][overlap_res[0]:overlap_res[1]]
+    overlap_seq2 = subreads[1][overlap_res[2]:overlap_res[3]]
+    overlap_qual2 = sub_qual[1][overlap_res[2]:overlap_res[3]]
 
-    poa_aligner = poa.msa_aligner(match=5)
+    poa_aligner = msa_aligner()
     res = poa_aligner.msa([overlap_seq1, overlap_seq2], out_cons=False, out_msa=True)
     if not res.msa_seq:
         return ''
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import threading
+
+# 2-bit codes for A, C, G, T; everything else breaks k-mers
+CODES = np.full(256, 4, dtype=np.int64)
+for i, base in enumerate('ACGT'):
+    CODES[ord(base)] = i
+    CODES[ord(base.lower())] = i
+
+# direct address table from k-mer code to position, reset after every use.
+# One per thread, read threads of a worker call find_overlap concurrently
+K = 11
+TABLES = threading.local()
+
+def kmer_table(tables, k):
+    '''The calling thread's table in tables (a threading.local) for k-mers of length k'''
+    if not hasattr(tables, 'table'):
+        tables.table = np.full(4 ** k, -1, dtype=np.int32)
+    return tables.table
+
+def kmer_codes(seq, k):
+    '''Returns integer codes for every k-mer in seq, -1 for k-mers containing N'''
+    bases = CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    if len(bases) < k:
+        return np.empty(0, dtype=np.int64)
+    # a k-mer code is the base 4 number spelled by its bases
+    codes = np.convolve(bases & 3, 4 ** np.arange(k, dtype=np.int64), mode='valid')
+    bad = np.convolve(bases == 4, np.ones(k, dtype=np.int64), mode='valid') > 0
+    codes[bad] = -1
+    return codes
+
+def seed_hits(window_codes, offset, search_codes):
+    '''Returns (window position, search position) for shared k-mers'''
+    table = kmer_table(TABLES, K)
+    valid = window_codes >= 0
+    positions = np.nonzero(valid)[0].astype(np.int32) + offset
+    table[window_codes[valid]] = positions
+    hits = table[np.where(search_codes >= 0, search_codes, 0)]
+    hits[search_codes < 0] = -1
+    table[window_codes[valid]] = -1
+    search_pos = np.nonzero(hits >= 0)[0]
+    return hits[search_pos], search_pos
+
+def find_overlap(ref, query, window=1000, band=50, min_anchors=3, min_span=80, extend=50):
+    '''
+    Finds the overlap between the end of query and the start of ref.
+    K-mers from the start of ref are looked up in query and k-mers from the end
+    of query are looked up in ref. Anchors that agree on a diagonal (within band)
+    are chained and the chain is extended to the sequence ends.
+    This replaces building a minimap2 index for a single overlap.
+
+    ref : str, the left dangling subread (overlap at its start)
+    query : str, the right dangling subread (overlap at its end)
+    window : int, how far into each sequence seeds are taken from
+    band : int, how far anchors can drift from the diagonal (indels)
+    min_anchors, min_span : int, chain requirements for reporting an overlap
+    extend : int, chains ending this close to a sequence end are extended to it
+
+    Returns [r_st, r_en, q_st, q_en] like the mappy hit it replaces,
+    or an empty list if there is no overlap.
+    '''
+    ref_codes, query_codes = kmer_codes(ref, K), kmer_codes(query, K)
+    if not len(ref_codes) or not len(query_codes):
+        return []
+    tail = max(len(query_codes) - window, 0)
+    r_head, q_head = seed_hits(ref_codes[:window], 0, query_codes)
+    q_tail, r_tail = seed_hits(query_codes[tail:], tail, ref_codes)
+    r_pos = np.concatenate((r_head, r_tail))
+    q_pos = np.concatenate((q_head, q_tail))
+    if len(r_pos) < min_anchors:
+        return []
+
+    # keep the largest group of anchors on (roughly) the same diagonal
+    diag = r_pos.astype(np.int64) - q_pos
+    order = np.argsort(diag, kind='stable')
+    diag = diag[order]
+    in_band = np.searchsorted(diag, diag + band, side='right') - np.arange(len(diag))
+    lo = int(np.argmax(in_band))
+    if in_band[lo] < min_anchors:
+        return []
+    chain = order[lo:lo + in_band[lo]]
+    r_pos, q_pos = r_pos[chain], q_pos[chain]
+
+    r_st, r_en = int(r_pos.min()), int(r_pos.max()) + K
+    q_st, q_en = int(q_pos.min()), int(q_pos.max()) + K
+    if min(r_en - r_st, q_en - q_st) < min_span:
+        return []
+
+    # extend the chain to the sequence ends along the diagonal
+    left = min(r_st, q_st)
+    if left <= extend:
+        r_st, q_st = r_st - left, q_st - left
+    right = min(len(ref) - r_en, len(query) - q_en)
+    if right <= extend:
+        r_en, q_en = r_en + right, q_en + right
+    return [r_st, r_en, q_st, q_en]
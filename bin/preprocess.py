@@ -3,25 +3,91 @@
 
 import os
 import sys
-import mappy as mm
+import numpy as np
+from read_input import iter_reads
+from profiler import waiting, profiled
+from result_cache import digest
+from read_batch import BatchPool
 from tqdm import tqdm
 import multiprocessing as mp
 import shutil
 from glob import glob
 
-def preprocess(blat, args, tmp_dir, tmp_adapter_dict, num_reads):
-    tmp_fasta = tmp_dir + 'R2C2_temp_for_BLAT.fasta'
-    align_psl = tmp_dir + 'splint_to_read_alignments.psl'
+BLAT_OPTIONS = '-noHead -stepSize=1 -t=DNA -q=DNA -minScore=15 -minIdentity=10'
 
-    # skip the alignment if the psl file already exists
-    if not os.path.exists(align_psl) or os.stat(align_psl).st_size == 0:
-        print('Aligning splints to reads with blat', file=sys.stderr)
-        chunk_process(num_reads, args, blat)
+def preprocess(blat, args, tmp_dir, tmp_adapter_dict, num_reads, blat_reads=None):
+    assignments_file = tmp_dir + 'splint_assignments.npz'
+    # reads with a cached splint assignment already have it in tmp_adapter_dict
+    if blat_reads is None:
+        blat_reads = tmp_adapter_dict
+
+    if os.path.exists(tmp_dir + 'splint_to_read_alignments.psl'):
+        print('Ignoring splint_to_read_alignments.psl, splint assignments are reused from '
+              'splint_assignments.npz if its inputs match', file=sys.stderr)
+    best, adapters = {}, set()
+    if not blat_reads:
+        print('All splint assignments were cached', file=sys.stderr)
     else:
-        print('Reading existing psl file', file=sys.stderr)
+        key = fingerprint(args, blat_reads)
+        loaded = load_assignments(assignments_file, key)
+        if loaded is not None:
+            print('Reading existing splint assignments', file=sys.stderr)
+            best, adapters = loaded
+        else:
+            if os.path.exists(assignments_file):
+                print('Splint assignments in ' + assignments_file + ' are from different reads, '
+                      'splints or parameters, aligning again', file=sys.stderr)
+            print('Aligning splints to reads with blat', file=sys.stderr)
+            best, adapters, complete = chunk_process(len(blat_reads), args, blat, blat_reads)
+            if complete:
+                save_assignments(assignments_file, key, best, adapters)
+            else:
+                print('Some blat chunks failed, splint assignments are not saved', file=sys.stderr)
+    return assign_splints(tmp_adapter_dict, best, adapters)
+
+def fingerprint(args, read_names):
+    '''
+    Digest of everything the splint assignments depend on: the read files (path,
+    size and modification time), the reads sent to blat, the splints and the
+    blat and filter parameters
+    '''
+    files = [(path, os.path.getsize(path), os.stat(path).st_mtime_ns) for path in args.reads]
+    with open(args.splint_file) as f:
+        splints = digest(f.read())
+    return digest(files, splints, BLAT_OPTIONS, args.lencutoff, args.qualcutoff, digest(*read_names))
+
+def save_assignments(path, key, best, adapters):
+    '''Best alignment per read as a structured array, with the fingerprint of its inputs'''
+    names = list(best)
+    name_len = max([len(name) for name in names] + [1])
+    splint_len = max([len(best[name][0]) for name in names] + [1])
+    table = np.array([(name,) + tuple(best[name]) for name in names],
+                     dtype=[('name', 'S' + str(name_len)), ('splint', 'S' + str(splint_len)),
+                            ('score', 'f4'), ('strand', 'S1')])
+    # np.savez appends .npz to names without it
+    np.savez(path, assignments=table, adapters=np.array(sorted(adapters), dtype='S'),
+             fingerprint=np.array(key))
 
-    adapter_set = set()
-    with open(align_psl) as f:
+def load_assignments(path, key):
+    '''(best, adapters) saved for the same fingerprint, or None'''
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if str(saved['fingerprint']) != key:
+            return None
+        assignments, adapters = saved['assignments'].tolist(), saved['adapters'].tolist()
+    best = {}
+    for name, splint, score, strand in assignments:
+        best[name.decode()] = [splint.decode(), score, strand.decode()]
+    return best, set(adapter.decode() for adapter in adapters)
+
+def reduce_psl(psl_file):
+    '''
+    Best [splint, score, strand] per read of a blat psl and the splints with any
+    passing alignment. The first of equally scoring alignments is kept.
+    '''
+    best, adapters = {}, set()
+    with open(psl_file) as f:
         for line in f:
             line = line.rstrip()
             if not line:
@@ -30,83 +96,117 @@ def preprocess(blat, args, tmp_dir, tmp_adapter_dict, num_reads):
             read_name, adapter, strand = line[9], line[13], line[8]
             gaps, score = float(line[5]), float(line[0])
             if gaps < 50 and score > 50:
-                tmp_adapter_dict[read_name].append([adapter, float(line[0]), strand])
-                adapter_set.add(adapter)
+                adapters.add(adapter)
+                if read_name not in best or score > best[read_name][1]:
+                    best[read_name] = [adapter, score, strand]
+    return best, adapters
+
+def assign_splints(tmp_adapter_dict, best, adapters):
+    '''Returns adapter_dict (read_id: [adapter, strand]), the splints seen and the reads without one'''
+    adapter_set = set(adapters)
+    for read_name, alignment in best.items():
+        # saved assignments can include reads that are now filtered out
+        if read_name in tmp_adapter_dict:
+            tmp_adapter_dict[read_name].append(alignment)
 
     adapter_dict = {} # read_id: [adapter, strand]
     no_splint_reads = 0
     for name, alignments in tmp_adapter_dict.items():
-        best = sorted(alignments, key=lambda x: x[1], reverse=True)[0]
-        if not best[0]:
+        best_alignment = sorted(alignments, key=lambda x: x[1], reverse=True)[0]
+        if not best_alignment[0]:
             no_splint_reads += 1
             continue
-        adapter_set.add(best[0])
-        adapter_dict[name] = [best[0], best[2]]
+        adapter_set.add(best_alignment[0])
+        adapter_dict[name] = [best_alignment[0], best_alignment[2]]
     return adapter_dict, adapter_set, no_splint_reads
 
-def cat_files(path, pattern, output):
-    '''Use glob to get around bash argument list limitations'''
-    final_psl = open(output, 'w+')
-    for f in tqdm(glob(path + pattern), desc='Catting psls'):
-        with open(f) as psl:
-            for line in psl:
-                final_psl.write(line)
-    final_psl.close()
-
 def remove_files(path, pattern):
     '''Use glob to get around bash argument list limitations'''
     for d in tqdm(glob(path + pattern), desc='Removing preprocessing files'):
         shutil.rmtree(d)
 
 def process(args, reads, blat, iteration):
+    '''
+    Aligns the splints to a chunk of reads, (name, seq, qual) tuples or a
+    ReadBatch, returns its reduce_psl result
+    '''
     tmp_dir = args.out_path + 'pre_tmp_' + str(iteration) + '/'
     if not os.path.isdir(tmp_dir):
         os.mkdir(tmp_dir)
     tmp_fa = tmp_dir + 'tmp_for_blat.fasta'
     tmp_fa_fh = open(tmp_fa, 'w+')
-    for header, seq in reads.items():
+    for header, seq, _ in reads:
         print('>' + header, file=tmp_fa_fh)
         print(seq, file=tmp_fa_fh)
     tmp_fa_fh.close()
+    if hasattr(reads, 'close'):
+        reads.close()
     align_psl = tmp_dir + 'tmp_splint_aln.psl'
     b_msgs = tmp_dir + 'blat_messages.log'
 
-    os.system('{blat} -noHead -stepSize=1 -t=DNA -q=DNA -minScore=15 \
-              -minIdentity=10 {splint} {reads} {psl} >{blat_msgs}'
-              .format(blat=blat, splint=args.splint_file, reads=tmp_fa, psl=align_psl, blat_msgs=b_msgs))
+    with waiting('blat'):
+        os.system('{blat} {options} {splint} {reads} {psl} >{blat_msgs}'
+                  .format(blat=blat, options=BLAT_OPTIONS, splint=args.splint_file,
+                          reads=tmp_fa, psl=align_psl, blat_msgs=b_msgs))
     os.remove(tmp_fa)
+    # only the best alignment per read goes back to the parent
+    best, adapters = reduce_psl(align_psl)
+    shutil.rmtree(tmp_dir)
+    return best, adapters
 
-def chunk_process(num_reads, args, blat):
-    '''Split the input fasta into chunks and process'''
+def chunk_process(num_reads, args, blat, read_names):
+    '''
+    Split the input fasta into chunks and process. Returns the merged best
+    alignments, splints and whether every chunk finished.
+    '''
+    procs = args.blatProcs if args.blatProcs else args.numThreads
     if args.blatThreads:
-        chunk_size = (num_reads // args.numThreads) + 1
+        chunk_size = (num_reads // procs) + 1
     else:
         chunk_size = args.groupSize
     if chunk_size > num_reads:
         chunk_size = num_reads
 
-    pool = mp.Pool(args.numThreads)
+    # with --profile the workers' stacks are merged by C3POa.py at the end of the run
+    profile_dir = args.out_path + 'tmp/profile/' if args.profile else ''
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    best, adapters, finished = {}, set(), []
+    def collect(result):
+        best.update(result[0])
+        adapters.update(result[1])
+        finished.append(1)
+        pbar.update(1)
+
+    batches = BatchPool(2 * procs) if args.read_batches == 'shared_memory' else None
+    pool = mp.Pool(procs)
     pbar = tqdm(total=num_reads // chunk_size + 1, desc='Preprocessing')
-    iteration, current_num, tmp_reads, target = 1, 0, {}, chunk_size
-    for read in mm.fastx_read(args.reads, read_comment=False):
-        if len(read[1]) < args.lencutoff:
+    iteration, current_num, tmp_reads, target = 1, 0, [], chunk_size
+    for read in iter_reads(args.reads, args.readerProcs):
+        # reads under the length or quality cutoff never get to blat
+        if read[0] not in read_names:
             continue
-        tmp_reads[read[0]] = read[1]
+        # blat only needs the sequences
+        tmp_reads.append((read[0], read[1], ''))
         current_num += 1
         if current_num == target:
-            pool.apply_async(process, args=(args, tmp_reads, blat, iteration), callback=lambda _: pbar.update(1))
+            if batches:
+                batch = batches.pack(tmp_reads)
+                pool.apply_async(*profiled(profile_dir, process, (args, batch, blat, iteration)),
+                                 callback=batches.released(batch, collect), error_callback=batches.released(batch))
+            else:
+                pool.apply_async(*profiled(profile_dir, process, (args, tmp_reads, blat, iteration)),
+                                 callback=collect)
             iteration += 1
             target = chunk_size * iteration
             if target >= num_reads:
                 target = num_reads
-            tmp_reads = {}
+            tmp_reads = []
     pool.close()
     pool.join()
     pbar.close()
-
-    cat_files(
-        args.out_path,
-        'pre_tmp_*/tmp_splint_aln.psl',
-        args.out_path + 'tmp/splint_to_read_alignments.psl'
-    )
+    if batches:
+        batches.close()
+    # failed chunks leave their tmp dirs behind
     remove_files(args.out_path, 'pre_tmp*')
+    return best, adapters, len(finished) == iteration - 1
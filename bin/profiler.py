@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import threading
+from glob import glob
+from contextlib import contextmanager
+
+# seconds between samples of a worker's main thread
+INTERVAL = 0.005
+# thread id: external tool the thread is waiting on (blat, racon)
+WAITING = {}
+
+@contextmanager
+def waiting(tool):
+    '''Marks the calling thread as waiting on an external tool while profiled'''
+    ident = threading.get_ident()
+    WAITING[ident] = tool
+    try:
+        yield
+    finally:
+        del WAITING[ident]
+
+def frame_name(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename) + ':' + code.co_name
+
+# frames of thread and pool machinery: a thread whose innermost frame is one of
+# these is idle (waiting for a task or for other threads) and is not sampled
+MACHINERY = ('threading.py', 'queue.py', 'pool.py', 'connection.py', 'selectors.py')
+
+class Sampler(threading.Thread):
+    '''
+    Samples the stacks of every thread of the process (the thread that creates
+    it and e.g. read threads) every INTERVAL seconds. A sample counts the
+    milliseconds since the previous one for each busy thread, so the totals
+    are thread seconds, and calls that hold the GIL and delay the sampler are
+    still charged for their time. Stacks stop at the frame of stop_at, the
+    pool and thread machinery above it is left out.
+    '''
+    def __init__(self, stop_at):
+        threading.Thread.__init__(self, daemon=True)
+        self.stop_at = stop_at
+        self.stacks, self.done = {}, threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.done.wait(INTERVAL):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None and frame.f_code is not self.stop_at:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                if not stack or stack[0].split(':')[0] in MACHINERY:
+                    continue
+                while stack[-1].split(':')[0] in MACHINERY:
+                    stack.pop()
+                # external tools get their own root, the python stack that started them below it
+                stack.append('[' + WAITING.get(ident, 'python') + ']')
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + (now - last) * 1000
+            last = now
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+def write_folded(stacks, path):
+    '''Collapsed stacks, one "frame;frame;frame milliseconds" line per stack'''
+    fh = open(path, 'a+')
+    for stack, ms in stacks.items():
+        if round(ms):
+            print(stack, round(ms), file=fh)
+    fh.close()
+
+def run_profiled(profile_dir, function, *args):
+    '''Pool task that runs function(*args) under a Sampler and appends its stacks to profile_dir'''
+    sampler = Sampler(run_profiled.__code__)
+    sampler.start()
+    try:
+        return function(*args)
+    finally:
+        sampler.stop()
+        write_folded(sampler.stacks, profile_dir + str(os.getpid()) + '.folded')
+
+def profiled(profile_dir, function, args):
+    '''(function, args) for pool.apply_async, wrapped in run_profiled if profile_dir is set'''
+    if not profile_dir:
+        return function, args
+    return run_profiled, (profile_dir, function) + tuple(args)
+
+def merge_profiles(profile_dir, output):
+    '''
+    Sums the stacks of all workers into one collapsed stack file (input for
+    flamegraph.pl or speedscope) and returns the milliseconds per root.
+    '''
+    stacks, roots = {}, {}
+    for path in glob(profile_dir + '*.folded'):
+        for line in open(path):
+            stack, ms = line.rstrip('\n').rsplit(' ', 1)
+            stacks[stack] = stacks.get(stack, 0) + int(ms)
+    fh = open(output, 'w+')
+    for stack in sorted(stacks):
+        print(stack, stacks[stack], file=fh)
+        root = stack.split(';', 1)[0]
+        roots[root] = roots.get(root, 0) + stacks[stack]
+    fh.close()
+    return roots
+
+def report_profile(roots, fh):
+    total = max(sum(roots.values()), 1)
+    for root in sorted(roots, key=roots.get, reverse=True):
+        print('Profile ' + root + ' worker thread seconds:', round(roots[root] / 1000, 1),
+              '({:.2f}%)'.format(roots[root] / total * 100), file=fh)
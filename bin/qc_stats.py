@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import json
+
+# histogram bin widths, values are stored under the lower edge of their bin
+BINS = {'repeats': 1, 'avg_qual': 1, 'seq_len': 500, 'cons_len': 100, 'cons_pct': 5}
+
+def new_stats():
+    '''Empty stats: run-wide counters and per splint histograms'''
+    return {'counters': {}, 'splints': {}}
+
+def count(stats, key, n=1):
+    stats['counters'][key] = stats['counters'].get(key, 0) + n
+
+def splint_entry(stats, splint):
+    if splint not in stats['splints']:
+        stats['splints'][splint] = {'reads': 0}
+        for key in BINS:
+            stats['splints'][splint][key] = {}
+    return stats['splints'][splint]
+
+def add_read(stats, splint, repeats, avg_qual, seq_len, cons_len):
+    '''Adds one consensus read to the histograms of its splint'''
+    splint_stats = splint_entry(stats, splint)
+    splint_stats['reads'] += 1
+    values = {'repeats': repeats, 'avg_qual': avg_qual, 'seq_len': seq_len,
+              'cons_len': cons_len, 'cons_pct': 100 * cons_len / seq_len}
+    for key, value in values.items():
+        # json keys have to be strings
+        edge = str(round(value // BINS[key] * BINS[key], 2))
+        splint_stats[key][edge] = splint_stats[key].get(edge, 0) + 1
+
+def merge_stats(total, part):
+    '''Adds the stats of one group into the run total'''
+    for key, n in part['counters'].items():
+        count(total, key, n)
+    for splint, splint_stats in part['splints'].items():
+        total_splint = splint_entry(total, splint)
+        total_splint['reads'] += splint_stats['reads']
+        for key in BINS:
+            for edge, n in splint_stats[key].items():
+                total_splint[key][edge] = total_splint[key].get(edge, 0) + n
+
+def write_stats(stats, path):
+    stats['bins'] = BINS
+    with open(path, 'w+') as f:
+        json.dump(stats, f, sort_keys=True)
+
+def read_stats(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import queue
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# count, name bytes, sequence bytes, quality bytes
+HEADER = 4
+# headroom when a block has to grow, so slightly larger groups still fit
+GROWTH = 1.25
+
+class ReadBatch:
+    '''
+    A group of (name, seq, qual) reads packed into a shared memory block:
+    a header, one offset array per field and the names, sequences and
+    qualities as contiguous bytes (one byte per base and per quality).
+    It pickles as the name of its block, so a worker attaches to the
+    parent's block instead of getting a copy of the reads, and indexes it
+    like the list it was packed from. Only the read asked for is decoded,
+    names() decodes just the names.
+    '''
+    def __init__(self, shm):
+        self.shm = shm
+        self.views()
+
+    def views(self):
+        header = np.ndarray(HEADER, dtype=np.int64, buffer=self.shm.buf)
+        self.count = int(header[0])
+        offsets = np.ndarray((3, self.count + 1), dtype=np.int64, buffer=self.shm.buf, offset=8 * HEADER)
+        self.offsets = offsets.tolist()
+        start = 8 * (HEADER + 3 * (self.count + 1))
+        self.fields = []
+        for length in header[1:].tolist():
+            self.fields.append(self.shm.buf[start:start + length])
+            start += length
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('read batch index out of range')
+        return tuple(str(field[offsets[i]:offsets[i + 1]], 'utf-8')
+                     for field, offsets in zip(self.fields, self.offsets))
+
+    def names(self):
+        '''The read names, without decoding any sequence or quality'''
+        field, offsets = self.fields[0], self.offsets[0]
+        return [str(field[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(self.count)]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def __getstate__(self):
+        return self.shm.name
+
+    def __setstate__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.views()
+
+    def detach(self):
+        '''Releases the views on the block, it can't be indexed after this'''
+        for field in self.fields:
+            field.release()
+        self.fields = []
+
+    def close(self):
+        '''Detaches from the block in a worker, the parent unlinks it'''
+        self.detach()
+        self.shm.close()
+
+class BatchPool:
+    '''
+    Shared memory blocks for read batches. pack() takes a free block, or
+    makes a new one while there are fewer than blocks, and otherwise waits
+    until a worker is done with one (release, from the task's callback).
+    This also limits how many groups the parent reads ahead of the workers.
+    Make it before the pool, forked workers have to share the parent's
+    resource tracker or theirs unlinks the blocks when they exit.
+    '''
+    def __init__(self, blocks):
+        self.blocks, self.made = blocks, []
+        self.free = queue.Queue()
+        resource_tracker.ensure_running()
+
+    def pack(self, reads):
+        '''ReadBatch of reads, (name, seq, qual) tuples'''
+        fields = [[read[i].encode() for read in reads] for i in range(3)]
+        lengths = np.array([[len(value) for value in field] for field in fields], dtype=np.int64).reshape(3, -1)
+        totals = lengths.sum(axis=1).tolist()
+        size = 8 * (HEADER + 3 * (len(reads) + 1)) + sum(totals)
+        if self.free.empty() and len(self.made) < self.blocks:
+            shm = self.new_block(size)
+        else:
+            shm = self.free.get()
+        if shm.size < size:
+            self.made.remove(shm)
+            shm.close()
+            shm.unlink()
+            shm = self.new_block(size)
+
+        header = np.ndarray(HEADER, dtype=np.int64, buffer=shm.buf)
+        header[:] = [len(reads)] + totals
+        offsets = np.ndarray((3, len(reads) + 1), dtype=np.int64, buffer=shm.buf, offset=8 * HEADER)
+        offsets[:, 0] = 0
+        np.cumsum(lengths, axis=1, out=offsets[:, 1:])
+        del header, offsets
+        # straight into the block, a reused block is already paged in
+        start = 8 * (HEADER + 3 * (len(reads) + 1))
+        for field in fields:
+            for value in field:
+                shm.buf[start:start + len(value)] = value
+                start += len(value)
+        return ReadBatch(shm)
+
+    def new_block(self, size):
+        shm = shared_memory.SharedMemory(create=True, size=int(size * GROWTH))
+        self.made.append(shm)
+        return shm
+
+    def release(self, batch):
+        '''Gives the block of batch back once its worker is done with it'''
+        batch.detach()
+        self.free.put(batch.shm)
+
+    def released(self, batch, callback=None):
+        '''apply_async callback (or error_callback) that gives the block back first'''
+        def done(result):
+            self.release(batch)
+            if callback:
+                callback(result)
+        return done
+
+    def close(self):
+        for shm in self.made:
+            shm.close()
+            shm.unlink()
+        self.made = []
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import queue
+import multiprocessing as mp
+from collections import deque
+from glob import glob
+import mappy as mm
+
+READ_EXTENSIONS = ('.fastq', '.fq', '.fasta', '.fa')
+
+def is_read_file(path):
+    if path.endswith('.gz'):
+        path = path[:-3]
+    return path.endswith(READ_EXTENSIONS)
+
+def resolve_inputs(paths):
+    '''
+    Expands read files, globs and directories (fastq/fasta, optionally gzipped)
+    into a list of files. Arguments keep their order, the files a glob or
+    directory expands to are sorted, so every pass sees the same read order.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(os.path.join(path, f) for f in os.listdir(path) if is_read_file(f))
+        elif any(c in path for c in '*?['):
+            matches = sorted(glob(path))
+        else:
+            matches = [path]
+        if not matches:
+            print('No read files found for ' + path, file=sys.stderr)
+        files += [f for f in matches if f not in files]
+    return files
+
+# reads per message from a reader process, and messages a reader may be ahead
+# of the parent, so the parent holds at most about procs * (READ_AHEAD + 1) chunks
+CHUNK_READS = 4000
+READ_AHEAD = 2
+
+def read_chunks(path, chunks):
+    '''
+    Reader process: decompresses and parses path and puts lists of up to
+    CHUNK_READS reads on the chunks queue, then None (or the exception)
+    '''
+    try:
+        chunk = []
+        for read in mm.fastx_read(path, read_comment=False):
+            chunk.append(read)
+            if len(chunk) == CHUNK_READS:
+                chunks.put(chunk)
+                chunk = []
+        if chunk:
+            chunks.put(chunk)
+    except Exception as e:
+        chunks.put(e)
+        return
+    chunks.put(None)
+
+def next_chunk(reader, chunks):
+    '''Next message of a reader, raises if the reader died before finishing its file'''
+    while True:
+        try:
+            return chunks.get(timeout=1)
+        except queue.Empty:
+            if not reader.is_alive():
+                break
+    # it may have put its last messages just before exiting
+    try:
+        return chunks.get(timeout=1)
+    except queue.Empty:
+        raise RuntimeError('Reader process exited with code ' + str(reader.exitcode)) from None
+
+def iter_reads(files, procs=1):
+    '''
+    Yields (name, seq, qual) for every read of every file in order. With more
+    than one file and process, the next procs files are parsed by reader
+    processes at once, each at most READ_AHEAD chunks ahead of the parent.
+    '''
+    if procs <= 1 or len(files) == 1:
+        for path in files:
+            for read in mm.fastx_read(path, read_comment=False):
+                yield read
+        return
+    readers, files = deque(), deque(files)
+    try:
+        while files or readers:
+            while files and len(readers) < procs:
+                chunks = mp.Queue(READ_AHEAD)
+                reader = mp.Process(target=read_chunks, args=(files.popleft(), chunks), daemon=True)
+                reader.start()
+                readers.append((reader, chunks))
+            reader, chunks = readers[0]
+            for chunk in iter(lambda: next_chunk(reader, chunks), None):
+                if isinstance(chunk, Exception):
+                    raise chunk
+                for read in chunk:
+                    yield read
+            readers.popleft()
+            reader.join()
+    finally:
+        # also stops the readers when the caller stops early
+        for reader, _ in readers:
+            reader.terminate()
+            reader.join()
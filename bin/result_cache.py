@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+def digest(*parts):
+    '''Content hash of everything a stage result depends on'''
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+class ResultCache:
+    '''
+    On-disk store of per read stage results (splint assignment, peaks, abPOA and
+    racon consensus) keyed by a hash of the read and the parameters of the stage.
+    Workers each open their own connection, read as they go and write their new
+    results in one transaction at the end of a group.
+    '''
+    def __init__(self, cache_dir):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # read threads of a worker share the connection
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'c3poa_cache.sqlite'), timeout=600,
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                        '(key TEXT PRIMARY KEY, stage TEXT, value BLOB, size INTEGER, used REAL)')
+        self.new, self.used = [], []
+        self.hits, self.misses = {}, {}
+
+    def get(self, stage, key):
+        '''Returns the cached value or None'''
+        with self.lock:
+            row = self.db.execute('SELECT value FROM results WHERE key = ?', (stage + key,)).fetchone()
+            if row is None:
+                self.misses[stage] = self.misses.get(stage, 0) + 1
+                return None
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            self.used.append(stage + key)
+        return pickle.loads(row[0])
+
+    def put(self, stage, key, value):
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.new.append((stage + key, stage, value, len(value)))
+
+    def flush(self):
+        '''Writes new results and refreshes the last use of hits'''
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                [row + (now,) for row in self.new])
+            self.db.executemany('UPDATE results SET used = ? WHERE key = ?',
+                                [(now, key) for key in self.used])
+        self.new, self.used = [], []
+
+    def evict(self, max_bytes):
+        '''Drops the least recently used results until the cache fits in max_bytes'''
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        removed, freed = [], 0
+        for key, size in self.db.execute('SELECT key, size FROM results ORDER BY used'):
+            if total - freed <= max_bytes:
+                break
+            removed.append((key,))
+            freed += size
+        with self.db:
+            self.db.executemany('DELETE FROM results WHERE key = ?', removed)
+        self.db.execute('VACUUM')
+        return len(removed)
+
+    def close(self):
+        self.flush()
+        self.db.close()
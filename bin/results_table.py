@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+# name and splint are fixed width byte strings sized to the longest value
+FIELDS = [('name', 'S'), ('splint', 'S'), ('strand', 'S1'), ('avg_qual', 'f4'),
+          ('seq_len', 'u4'), ('repeats', 'u2'), ('subreads_used', 'u2'), ('cons_len', 'u4'),
+          ('peaks', 'u2'), ('offset', 'u8')]
+
+def table_dtype(name_len, splint_len):
+    widths = {'name': name_len, 'splint': splint_len}
+    return np.dtype([(field, kind + str(widths[field]) if field in widths else kind)
+                     for field, kind in FIELDS])
+
+def to_array(rows):
+    '''Turns a list of row tuples (in FIELDS order) into a structured array'''
+    name_len = max([len(row[0]) for row in rows] + [1])
+    splint_len = max([len(row[1]) for row in rows] + [1])
+    return np.array(rows, dtype=table_dtype(name_len, splint_len))
+
+def write_rows(rows, path):
+    np.save(path, to_array(rows))
+
+def merge_tables(parts, output):
+    '''
+    Concatenates per group tables into one.
+    parts : list of (table path, byte offset of that group's records in the final fasta)
+    '''
+    tables = []
+    for path, base in parts:
+        if not os.path.exists(path):
+            continue
+        table = np.load(path)
+        table['offset'] += base
+        tables.append(table)
+    name_len = max([t.dtype['name'].itemsize for t in tables] + [1])
+    splint_len = max([t.dtype['splint'].itemsize for t in tables] + [1])
+    dtype = table_dtype(name_len, splint_len)
+    merged = np.concatenate([t.astype(dtype) for t in tables]) if tables else np.empty(0, dtype=dtype)
+    np.save(output, merged)
+    return len(merged)
+
+def load_table(path):
+    '''Memory maps a results table, filter it like any structured array'''
+    return np.load(path, mmap_mode='r')
+
+def fetch(rows, out_path):
+    '''
+    Yields (header, sequence) for table rows without scanning the consensus fasta.
+    Offsets point into the uncompressed out_path/<splint>/R2C2_Consensus.fasta.
+    '''
+    handles = {}
+    for row in rows:
+        splint = row['splint'].decode()
+        if splint not in handles:
+            handles[splint] = open(os.path.join(out_path, splint, 'R2C2_Consensus.fasta'), 'rb')
+        fh = handles[splint]
+        fh.seek(int(row['offset']))
+        header = fh.readline().decode().rstrip()[1:]
+        yield header, fh.readline().decode().rstrip()
+    for fh in handles.values():
+        fh.close()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import itertools
+from conk import conk
+from call_peaks import smooth_scores, pick_peaks, place_peaks, split_read
+from overlap import find_overlap
+
+# defaults are the values analyze_reads uses
+SWEEP_PARAMS = ['penalty', 'iters', 'window', 'order', 'mdistcutoff', 'tolerance']
+SWEEP_TYPES = {'penalty': int, 'iters': int, 'window': int, 'order': int,
+               'mdistcutoff': int, 'tolerance': float}
+MAX_REPEATS = 10
+
+def parse_grid(grid_string, mdistcutoff):
+    '''
+    Parses "mdistcutoff=300,500;window=31,41" into a list of settings.
+    Parameters that are not given keep their default value.
+    '''
+    values = {'penalty': [20], 'iters': [3], 'window': [41], 'order': [2],
+              'mdistcutoff': [mdistcutoff], 'tolerance': [0.2]}
+    for entry in grid_string.split(';'):
+        if not entry.strip():
+            continue
+        param, options = entry.split('=')
+        param = param.strip()
+        if param not in SWEEP_TYPES:
+            raise ValueError('Cannot sweep ' + param + ', use one of ' + ', '.join(SWEEP_PARAMS))
+        values[param] = [SWEEP_TYPES[param](x) for x in options.split(',')]
+    return [dict(zip(SWEEP_PARAMS, setting))
+            for setting in itertools.product(*[values[param] for param in SWEEP_PARAMS])]
+
+def new_summary(grid):
+    return [{'reads': 0, 'with_peaks': 0, 'yield': 0, 'subreads': 0,
+             'repeats': [0] * (MAX_REPEATS + 1)} for _ in grid]
+
+def merge_summary(total, part):
+    for setting_total, setting_part in zip(total, part):
+        for key in ['reads', 'with_peaks', 'yield', 'subreads']:
+            setting_total[key] += setting_part[key]
+        for i, n in enumerate(setting_part['repeats']):
+            setting_total['repeats'][i] += n
+
+def sweep_reads(args, reads, splint_dict, adapter_dict, grid):
+    '''
+    Evaluates every grid setting on each read. The conk score track is computed
+    once per read (and penalty) and the smoothed track once per smoothing setting.
+    '''
+    summary = new_summary(grid)
+    for name, seq, qual in reads:
+        if not adapter_dict.get(name):
+            continue
+        adapter, strand = adapter_dict[name]
+        splint = splint_dict[adapter][1] if strand == '-' else splint_dict[adapter][0]
+        raw_scores, smoothed = {}, {}
+        for setting, setting_summary in zip(grid, summary):
+            penalty = setting['penalty']
+            if penalty not in raw_scores:
+                raw_scores[penalty] = conk.conk(splint, seq, penalty)
+            smoothing = (penalty, setting['iters'], setting['window'], setting['order'])
+            if smoothing not in smoothed:
+                smoothed[smoothing] = smooth_scores(raw_scores[penalty], *smoothing[1:])
+            setting_summary['reads'] += 1
+            peaks = pick_peaks(smoothed[smoothing], setting['mdistcutoff'])
+            peaks = place_peaks(peaks, len(splint), len(seq))
+            if not peaks:
+                continue
+            setting_summary['with_peaks'] += 1
+            subreads, _, dangling, _ = split_read(seq, qual, peaks, setting['tolerance'])
+            repeats = len(subreads)
+            setting_summary['repeats'][min(repeats, MAX_REPEATS)] += 1
+            setting_summary['subreads'] += repeats
+            if repeats:
+                setting_summary['yield'] += 1
+            elif args.zero and len(dangling) == 2:
+                # a zero repeat read only gives a consensus if its halves overlap
+                overlap = find_overlap(dangling[0], dangling[1])
+                if overlap and overlap[2] + len(dangling[0]) - overlap[0] >= setting['mdistcutoff']:
+                    setting_summary['yield'] += 1
+    # shared memory batch (read_batch.ReadBatch) of the parent
+    if hasattr(reads, 'close'):
+        reads.close()
+    return summary
+
+def write_summary(grid, summary, output):
+    out = open(output, 'w+')
+    repeat_cols = ['repeats_' + str(i) for i in range(MAX_REPEATS)] + ['repeats_' + str(MAX_REPEATS) + '+']
+    print('\t'.join(SWEEP_PARAMS + ['reads', 'with_peaks', 'consensus_yield', 'yield_pct',
+                                    'mean_repeats'] + repeat_cols), file=out)
+    for setting, s in zip(grid, summary):
+        with_peaks = max(s['with_peaks'], 1)
+        row = [setting[param] for param in SWEEP_PARAMS]
+        row += [s['reads'], s['with_peaks'], s['yield'],
+                round(100 * s['yield'] / max(s['reads'], 1), 2),
+                round(s['subreads'] / with_peaks, 2)] + s['repeats']
+        print('\t'.join(str(x) for x in row), file=out)
+    out.close()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 # alice siqi chen
 
-import os 
-import sys 
+import os
+import sys
 import argparse
 
+PATH = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/bin/'
+sys.path.append(os.path.abspath(PATH))
+
+from qc_stats import read_stats
+
 
 def parse_args():
     '''Parses arguments.'''
@@ -12,35 +17,54 @@ def parse_args():
                                      add_help=True,
                                      prefix_chars='-')
     parser.add_argument('--input_file', '-i', type=str, action='store',
-                        help='Fasta file with consensus called R2C2 reads (output from C3POa.py)')   #gives full path to 'R2C2_Consensus.fasta' generated from C3POa 
+                        help='''c3poa_stats.json (or the C3POa output directory containing it).
+                                A consensus fasta still works but has to be read in full.''')
+    parser.add_argument('--splint', '-s', type=str, action='store', default='',
+                        help='Only count reads from this splint (stats file only).')
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(0)
     #print(parser.parse_args())
     return parser.parse_args()
 
-args = parse_args()
-inFile =args.input_file
+
+def zero_repeat_stats(stats_file, splint):
+  '''Reads the repeat histograms C3POa collects while calling consensi'''
+  stats = read_stats(stats_file)
+  read_count, zero_count = 0, 0
+  for name, splint_stats in stats['splints'].items():
+    if splint and name != splint:
+        continue
+    read_count += splint_stats['reads']
+    zero_count += splint_stats['repeats'].get('0', 0)
+  return read_count, zero_count
 
 
-def zero_repeat(inFile):
-  read_count = 0
-  count = 0
+def zero_repeat_fasta(inFile):
+  '''Old full scan of the consensus headers (name_avgQual_length_repeats_consLength)'''
+  read_count, zero_count = 0, 0
   for line in open(inFile):
     if line.startswith('>'):
-        line=line.rstrip()
-        subread=int(line.split('_')[3])
-        if subread>=1:
-            count+=1
-        else: 
-            continue
-    else:
-        read_count+=1
-        continue
-  #print(count)    
-  #print(read_count)
-  percent_zero_repeat = "{:.0%}".format(float((read_count-count)/read_count))
+        read_count += 1
+        # read names can contain underscores, so count fields from the end
+        repeats = int(line.rstrip().split('_')[-2])
+        if repeats == 0:
+            zero_count += 1
+  return read_count, zero_count
+
+
+def zero_repeat(inFile, splint=''):
+  if os.path.isdir(inFile):
+    inFile = os.path.join(inFile, 'c3poa_stats.json')
+  if inFile.endswith('.json'):
+    read_count, zero_count = zero_repeat_stats(inFile, splint)
+  else:
+    read_count, zero_count = zero_repeat_fasta(inFile)
+  percent_zero_repeat = "{:.0%}".format(float(zero_count/read_count))
   print('%s of total reads has zero repeats'%percent_zero_repeat)
   return percent_zero_repeat
 
-zero_repeat(inFile)
+
+if __name__ == '__main__':
+  args = parse_args()
+  zero_repeat(args.input_file, args.splint)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import shutil
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import mappy as mm
+import editdistance as ld
+
+ROOT = '/'.join(os.path.realpath(__file__).split('/')[:-2]) + '/'
+GOLDEN = ROOT + 'golden/'
+# deterministic stand-ins for blat, racon and conk, so the golden outputs do
+# not depend on the versions that are installed. The stand-in racon returns
+# the abPOA consensus unchanged, so they only check how reads are dispatched.
+TOOLS = GOLDEN + 'tools/'
+READS = GOLDEN + 'fixtures/r2c2_reads.fastq'
+CONSENSUS = GOLDEN + 'fixtures/consensus_reads.fasta'
+
+# C3POa execution modes that have to reproduce the reference (-n 1) outputs with
+# the stand-in tools. They change how reads are read, dispatched, cached or
+# scored, not what racon gets. {work} is replaced by the mode's work directory,
+# {parts} by the fixture split over several plain and gzipped files.
+MODES = {
+    'reference': [],
+    'threads': ['-n', '2', '-g', '7'],
+    'scratch': ['--scratch', '{work}scratch'],
+    'cache_cold': ['--cache', '{work}../cache'],
+    'cache_warm': ['--cache', '{work}../cache'],
+    'multi_file': ['-r', '{parts}'],
+    'autotune': ['--autotune', '--autotune_reads', '10'],
+    'coarse_scoring': ['--coarse_scoring', '1000'],
+    'read_threads': ['-n', '2', '-g', '7', '--readThreads', '3'],
+    'shared_memory': ['-n', '2', '-g', '7', '--read_batches', 'shared_memory'],
+    # the longest reads of the fixture are called after the groups, one per task
+    'slow_lane': ['-n', '2', '-g', '7', '--guard_length', '6000'],
+}
+# settings that change the outputs, each has golden outputs of its own. The
+# fixture has reads with up to 6 repeats, a budget of 3 caps the 4 and 6 repeat ones.
+OUTPUT_MODES = {
+    'subread_budget_polish': ['--max_subreads', '3', '--extra_subreads', 'polish'],
+    'subread_budget_drop': ['--max_subreads', '3', '--extra_subreads', 'drop'],
+}
+# modes that change what racon gets (or replace a slower step), which only the
+# real tools can check. With --tools installed they run on the installed blat,
+# racon and conk and are compared with a reference run on the same tools:
+# consensus within --tolerance, subreads identical.
+INSTALLED_MODES = {
+    'msa_overlaps': ['--racon_overlaps', 'msa'],
+    'read_threads': ['-n', '2', '-g', '7', '--readThreads', '3'],
+    'guard_timeout': ['--guard_timeout', '600'],
+    'polish_adaptive': ['--polish', 'adaptive'],
+    'subread_budget_polish': ['--max_subreads', '3', '--extra_subreads', 'polish'],
+    'coarse_scoring': ['--coarse_scoring', '1000'],
+}
+# postprocessing settings, each run single process (streaming) and with a pool
+POST_SETTINGS = {
+    'default': [],
+    'trim': ['-t'],
+    'demux': ['-x', ROOT + 'oligodt_indexes.fasta'],
+}
+POST_MODES = {
+    'reference': [],
+    'threads': ['-n', '2', '-g', '50'],
+}
+
+def parse_args():
+    '''Parses arguments.'''
+    parser = argparse.ArgumentParser(description='Checks C3POa execution modes against golden outputs.',
+                                     add_help=True,
+                                     prefix_chars='-')
+    parser.add_argument('--update', action='store_true', default=False,
+                        help='''Regenerate the golden outputs from the reference mode, only for
+                                changes that are meant to change the outputs.''')
+    parser.add_argument('--tools', type=str, action='store', default='stand_in',
+                        choices=['stand_in', 'installed'],
+                        help='''"stand_in" checks the execution modes against the golden outputs
+                                with the tools in golden/tools. "installed" checks the modes that
+                                change what racon gets on the installed blat, racon and conk
+                                against a reference run on them. Defaults to stand_in.''')
+    parser.add_argument('--modes', type=str, action='store', default='',
+                        help='Comma separated modes to check. Defaults to all of them.')
+    parser.add_argument('--tolerance', type=float, action='store', default=0.01,
+                        help='''Largest edit distance, as a fraction of the length, allowed
+                                between a consensus and its golden sequence. Defaults to 0.01.''')
+    parser.add_argument('--work', type=str, action='store', default='',
+                        help='Directory for the runs. Defaults to a removed temporary directory.')
+    return parser.parse_args()
+
+def split_fixture(path):
+    '''Writes the fixture reads round robin into a plain and a gzipped file'''
+    reads = list(mm.fastx_read(READS, read_comment=False))
+    parts = [open(path + 'part0.fastq', 'w+'), gzip.open(path + 'part1.fastq.gz', 'wt')]
+    for i, (name, seq, qual) in enumerate(reads):
+        print('@' + name, seq, '+', qual, sep='\n', file=parts[i % 2])
+    for fh in parts:
+        fh.close()
+    return path
+
+def installed_tools():
+    '''Missing blat, racon and conk, or the ones that resolve to the stand-ins'''
+    paths = {tool: shutil.which(tool) for tool in ['blat', 'racon']}
+    spec = importlib.util.find_spec('conk')
+    paths['conk'] = spec.origin if spec else None
+    return [tool for tool, path in sorted(paths.items())
+            if not path or os.path.realpath(path).startswith(TOOLS)]
+
+def run(cmd, stand_ins=True):
+    '''Runs a C3POa script, with the tools in TOOLS unless stand_ins is False'''
+    env = dict(os.environ)
+    if stand_ins:
+        env['PATH'] = TOOLS + os.pathsep + env.get('PATH', '')
+        env['PYTHONPATH'] = os.pathsep.join([TOOLS] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    result = subprocess.run([sys.executable] + cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True, env=env)
+    if result.returncode:
+        print(result.stderr, file=sys.stderr)
+        raise RuntimeError('Failed: ' + ' '.join(cmd))
+
+def run_c3poa(work, mode, options, stand_ins=True):
+    out_path = work + 'c3poa_' + mode + '/'
+    os.makedirs(out_path)
+    parts = split_fixture(out_path) if '{parts}' in options else ''
+    extra = [x.format(work=out_path, parts=parts) for x in options]
+    cmd = [ROOT + 'C3POa.py', '-r', READS, '-s', ROOT + 'splint.fasta', '-o', out_path, '-n', '1']
+    run(cmd + extra, stand_ins)
+    return out_path
+
+def run_post(work, setting, mode):
+    out_path = work + 'post_' + setting + '_' + mode + '/'
+    os.makedirs(out_path)
+    cmd = [ROOT + 'C3POa_postprocessing.py', '-i', CONSENSUS, '-a', ROOT + 'adapter.fasta',
+           '-o', out_path, '-n', '1']
+    run(cmd + POST_SETTINGS[setting] + POST_MODES[mode])
+    return out_path
+
+def golden_files(path):
+    '''Outputs that are compared, relative to the output directory'''
+    files = []
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            f = os.path.relpath(os.path.join(root, name), path)
+            if name.startswith('R2C2_') and name.endswith(('.fasta', '.fastq', '.tsv')) \
+               and not f.startswith(('tmp/', 'scratch/')):
+                files.append(f)
+    return sorted(files)
+
+def read_records(path, strip_length=False):
+    '''
+    name: sequence for fasta/fastq, line: line for tsv files. strip_length drops
+    the consensus length from the end of the names, so consensi of different
+    lengths are still matched.
+    '''
+    if path.endswith('.tsv'):
+        return {line: line for line in open(path).read().splitlines()}
+    return {name.rsplit('_', 1)[0] if strip_length else name: seq
+            for name, seq, _ in mm.fastx_read(path, read_comment=False)}
+
+def compare(expected, actual, tolerance):
+    '''
+    Returns a list of differences. Records are matched by name, so the order
+    in which groups were written does not matter. Sequences may differ by up to
+    tolerance (racon and abPOA consensus), everything else has to be identical.
+    '''
+    if not os.path.exists(actual):
+        return ['missing']
+    expected, actual = read_records(expected, tolerance > 0), read_records(actual, tolerance > 0)
+    problems = []
+    missing = [name for name in expected if name not in actual]
+    extra = [name for name in actual if name not in expected]
+    if missing:
+        problems.append(str(len(missing)) + ' records missing, e.g. ' + missing[0])
+    if extra:
+        problems.append(str(len(extra)) + ' unexpected records, e.g. ' + extra[0])
+    for name, seq in expected.items():
+        if name not in actual or actual[name] == seq:
+            continue
+        distance = ld.eval(seq, actual[name]) / max(len(seq), 1)
+        if distance > tolerance:
+            problems.append(name + ' differs by {:.2%}'.format(distance))
+    return problems
+
+def check(expected_dir, actual_dir, label, tolerance, skip=()):
+    '''Compares the outputs of a run with expected_dir, except the file names in skip'''
+    failures = 0
+    expected_files = [f for f in golden_files(expected_dir) if os.path.basename(f) not in skip]
+    if not expected_files:
+        print(label, expected_dir, 'FAIL', 'no golden outputs', sep='\t')
+        return 1
+    actual_files = [f for f in golden_files(actual_dir) if os.path.basename(f) not in skip]
+    for f in sorted(set(expected_files) | set(actual_files)):
+        if f not in expected_files:
+            problems = ['not in the golden outputs']
+        else:
+            # subreads and postprocessing outputs are deterministic
+            tol = tolerance if f.endswith('R2C2_Consensus.fasta') else 0
+            problems = compare(expected_dir + f, actual_dir + f, tol)
+        print(label, f, 'FAIL' if problems else 'OK', '; '.join(problems[:3]), sep='\t')
+        failures += bool(problems)
+    return failures
+
+def update(work):
+    if os.path.exists(GOLDEN + 'expected'):
+        shutil.rmtree(GOLDEN + 'expected')
+    runs = [('c3poa', run_c3poa(work, 'reference', MODES['reference']))]
+    for mode, options in OUTPUT_MODES.items():
+        runs.append(('c3poa_' + mode, run_c3poa(work, mode, options)))
+    for setting in POST_SETTINGS:
+        runs.append(('post_' + setting, run_post(work, setting, 'reference')))
+    for name, out_path in runs:
+        for f in golden_files(out_path):
+            target = GOLDEN + 'expected/' + name + '/' + f
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy(out_path + f, target)
+            print('Updated', name + '/' + f, file=sys.stderr)
+
+def check_installed(args, work):
+    '''
+    Runs the reference and INSTALLED_MODES on the installed tools. Polish paths
+    are not compared, the modes are allowed to take a different path per read.
+    '''
+    missing = installed_tools()
+    if missing:
+        print('--tools installed needs real installs of blat, racon and conk, missing or stand-ins:',
+              ', '.join(missing), file=sys.stderr)
+        return 1
+    reference = run_c3poa(work, 'installed_reference', MODES['reference'], stand_ins=False)
+    failures = 0
+    for mode in args.modes.split(',') if args.modes else list(INSTALLED_MODES):
+        out_path = run_c3poa(work, 'installed_' + mode, INSTALLED_MODES[mode], stand_ins=False)
+        failures += check(reference, out_path, 'installed_' + mode, args.tolerance,
+                          skip=('R2C2_Polish_Paths.tsv',))
+    print(str(failures) + ' failed comparisons', file=sys.stderr)
+    return 1 if failures else 0
+
+def main(args):
+    if args.update and args.tools == 'installed':
+        print('--update makes the golden outputs with the stand-in tools only', file=sys.stderr)
+        return 1
+    if args.tools == 'stand_in' and not args.update and not os.path.isdir(GOLDEN + 'expected'):
+        print(GOLDEN + 'expected is missing, the golden outputs are part of the repository',
+              file=sys.stderr)
+        return 1
+    work = args.work if args.work else tempfile.mkdtemp(prefix='c3poa_golden_')
+    work = os.path.abspath(work) + '/'
+    try:
+        if args.update:
+            update(work)
+            return 0
+        if args.tools == 'installed':
+            return check_installed(args, work)
+        modes = args.modes.split(',') if args.modes else list(MODES) + list(OUTPUT_MODES)
+        failures = 0
+        for mode in modes:
+            if mode in MODES:
+                out_path = run_c3poa(work, mode, MODES[mode])
+                failures += check(GOLDEN + 'expected/c3poa/', out_path, mode, args.tolerance)
+            if mode in OUTPUT_MODES:
+                out_path = run_c3poa(work, mode, OUTPUT_MODES[mode])
+                failures += check(GOLDEN + 'expected/c3poa_' + mode + '/', out_path, mode, args.tolerance)
+            if mode in POST_MODES:
+                for setting in POST_SETTINGS:
+                    out_path = run_post(work, setting, mode)
+                    failures += check(GOLDEN + 'expected/post_' + setting + '/', out_path,
+                                      'post_' + setting + '_' + mode, args.tolerance)
+        print(str(failures) + ' failed comparisons', file=sys.stderr)
+        return 1 if failures else 0
+    finally:
+        if not args.work:
+            shutil.rmtree(work)
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import mappy as mm
+
+ROOT = '/'.join(os.path.realpath(__file__).split('/')[:-2]) + '/'
+FIXTURES = ROOT + 'golden/fixtures/'
+BASES = 'ACGT'
+
+def random_seq(rng, length):
+    return ''.join(rng.choice(BASES) for _ in range(length))
+
+def mutate(rng, seq, error):
+    '''Nanopore-like errors, a third each of deletions, insertions and substitutions'''
+    out = []
+    for base in seq:
+        r = rng.random()
+        if r < error / 3:
+            continue
+        elif r < 2 * error / 3:
+            out += [base, rng.choice(BASES)]
+        elif r < error:
+            out.append(rng.choice(BASES))
+        else:
+            out.append(base)
+    return ''.join(out)
+
+def quality(rng, length):
+    return ''.join(chr(33 + rng.randint(5, 30)) for _ in range(length))
+
+def r2c2_reads(rng, splint, adapters, num_reads):
+    '''
+    Concatemers of splint + insert with 0 to 6 full repeats, random strand,
+    a few reads under the length cutoff and a few without a splint
+    '''
+    reads = []
+    for i in range(num_reads):
+        insert = (adapters['5Prime_adapter'].replace('N', 'A') + random_seq(rng, rng.randint(500, 1000))
+                  + mm.revcomp(adapters['3Prime_adapter']))
+        unit = splint + insert
+        repeats = [0, 1, 2, 3, 4, 6][i % 6]
+        seq = insert[rng.randint(0, len(insert) // 2):] + unit * repeats + splint
+        seq += insert[:rng.randint(200, len(insert))]
+        seq = mutate(rng, seq, 0.06)
+        if rng.random() < 0.5:
+            seq = mm.revcomp(seq)
+        if i % 15 == 7:
+            seq = seq[:700]
+        if i % 15 == 11:
+            seq = random_seq(rng, 3000)
+        reads.append(('fixture_read_' + str(i), seq, quality(rng, len(seq))))
+    return reads
+
+def consensus_reads(rng, adapters, indexes, num_reads):
+    '''Consensus-like reads for postprocessing, with oligo dT indexes'''
+    reads = []
+    for i in range(num_reads):
+        insert = random_seq(rng, rng.randint(300, 900))
+        index = indexes[i % len(indexes)]
+        seq = (random_seq(rng, 30) + adapters['5Prime_adapter'].replace('N', 'A') + random_seq(rng, 4)
+               + insert + mm.revcomp(index) + mm.revcomp(adapters['3Prime_adapter']) + random_seq(rng, 30))
+        seq = mutate(rng, seq, 0.01)
+        if rng.random() < 0.5:
+            seq = mm.revcomp(seq)
+        if i % 10 == 3:
+            seq = random_seq(rng, 800)
+        reads.append(('fixture_cons_' + str(i) + '_30.0_' + str(len(seq)) + '_3_' + str(len(seq)), seq))
+    return reads
+
+def main():
+    rng = random.Random(2021)
+    splint = [seq for _, seq, _ in mm.fastx_read(ROOT + 'splint.fasta', read_comment=False)][0]
+    adapters = {name: seq for name, seq, _ in mm.fastx_read(ROOT + 'adapter.fasta', read_comment=False)}
+    indexes = [seq for _, seq, _ in mm.fastx_read(ROOT + 'oligodt_indexes.fasta', read_comment=False)]
+
+    reads = r2c2_reads(rng, splint, adapters, 30)
+    out = open(FIXTURES + 'r2c2_reads.fastq', 'w+')
+    for name, seq, qual in reads:
+        print('@' + name, seq, '+', qual, sep='\n', file=out)
+    out.close()
+
+    out = open(FIXTURES + 'consensus_reads.fasta', 'w+')
+    for name, seq in consensus_reads(rng, adapters, indexes, 200):
+        print('>' + name, seq, sep='\n', file=out)
+    out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+'''
+Pure python stand-in for conk used by the golden checks: every k-mer of the
+read that is also in the splint votes for the splint start it implies.
+'''
+
+import numpy as np
+
+K = 10
+
+def conk(splint, seq, penalty):
+    kmers = {}
+    for i in range(len(splint) - K + 1):
+        kmers.setdefault(splint[i:i + K], i)
+    scores = np.ones(len(seq), dtype=float)
+    for i in range(len(seq) - K + 1):
+        j = kmers.get(seq[i:i + K])
+        if j is not None and i - j >= 0:
+            scores[i - j] += 1
+    return scores
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import argparse
+
+PATH = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/bin/'
+sys.path.append(os.path.abspath(PATH))
+
+from read_input import resolve_inputs, iter_reads
+
+def parse_args():
+    '''Parses arguments.'''
+    parser = argparse.ArgumentParser(description='Writes the subread fastq of a C3POa run from its subread coordinates.',
+                                     add_help=True,
+                                     prefix_chars='-')
+    parser.add_argument('--input_file', '-i', type=str, action='store',
+                        help='R2C2_Subreads.tsv(.gz) written by C3POa.py --subread_output coords.')
+    parser.add_argument('--reads', '-r', type=str, action='store', nargs='+',
+                        help='The read files (or globs, directories) C3POa.py was run on.')
+    parser.add_argument('--output', '-o', type=str, action='store', default='',
+                        help='Subread fastq to write (.gz is compressed). Defaults to stdout.')
+    parser.add_argument('--readerProcs', type=int, default=1,
+                        help='Processes that parse read files when there are several of them. Defaults to 1.')
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(0)
+    return parser.parse_args()
+
+def read_coords(path):
+    '''Returns read name: [(index, start, end), ...] in file order'''
+    coords = {}
+    fh = gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+    for line in fh:
+        name, index, start, end = line.rstrip('\n').split('\t')
+        coords.setdefault(name, []).append((index, int(start), int(end)))
+    fh.close()
+    return coords
+
+def materialize(coords, reads, fh):
+    '''
+    Writes the subreads of every read that has coordinates, in input read
+    order. Returns the number of reads that were not found in the input.
+    '''
+    for name, seq, qual in reads:
+        for index, start, end in coords.pop(name, []):
+            print('@{name}\n{sub}\n+\n{q}'.format(name=name + '_' + index, sub=seq[start:end], q=qual[start:end]), file=fh)
+    return len(coords)
+
+def main(args):
+    coords = read_coords(args.input_file)
+    if not args.output:
+        fh = sys.stdout
+    elif args.output.endswith('.gz'):
+        fh = gzip.open(args.output, 'wt')
+    else:
+        fh = open(args.output, 'w+')
+    missing = materialize(coords, iter_reads(resolve_inputs(args.reads), args.readerProcs), fh)
+    if fh is not sys.stdout:
+        fh.close()
+    if missing:
+        print(missing, 'reads with subreads were not in the input', file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.input_file or not args.reads:
+        print('Subread coordinates (--input_file/-i) and reads (--reads/-r) are required', file=sys.stderr)
+        sys.exit(1)
+    main(args)
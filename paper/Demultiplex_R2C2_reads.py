@@ -2,93 +2,175 @@ import sys
 import os
 import numpy as np
 import argparse
+import multiprocessing as mp
 import editdistance as ld
+from collections import deque
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input_fasta_file', type=str)
 parser.add_argument('-o', '--output_path', type=str)
 parser.add_argument('-n', '--nextera_index_file', type=str)
 parser.add_argument('-t', '--tso_index_file', type=str)
+parser.add_argument('-j', '--threads', type=int, default=1)
+parser.add_argument('-b', '--batch_size', type=int, default=2000)
 
-args = parser.parse_args()
-output_path = args.output_path + '/'
-input_file = args.input_fasta_file
-nextera_file = args.nextera_index_file
-tso_file = args.tso_index_file
+# only the start of a read is searched for indexes
+SEARCH_LEN = 300
+MAX_DIST = 4
+
+# 2-bit codes for A, C, G, T; everything else is 4
+CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    CODES[ord(base)] = i
 
 def read_fasta(inFile):
     readDict = {}
+    for name, seq in stream_fasta(inFile):
+        readDict[name] = seq
+    return readDict
+
+def stream_fasta(inFile):
+    lastHead, seq = None, []
     for line in open(inFile):
         line = line.rstrip()
         if not line:
             continue
         if line.startswith('>'):
-            readDict[line[1:]] = ''
-            lastHead = line[1:]
+            if lastHead is not None:
+                yield lastHead, ''.join(seq)
+            lastHead, seq = line[1:], []
         else:
-            readDict[lastHead] += line
-    return readDict
+            seq.append(line)
+    if lastHead is not None:
+        yield lastHead, ''.join(seq)
 
 def reverse_complement(sequence):
     bases = {'A':'T', 'C':'G', 'G':'C', 'T':'A', 'N':'N', '-':'-'}
     return ''.join([bases[x] for x in list(sequence)])[::-1]
 
-def demultiplex(reads, Nextera_Indexes, TSO_Indexes):
-    Nexts = read_fasta(Nextera_Indexes)
-    TSOs = read_fasta(TSO_Indexes)
-    indexed_reads = {}
-    counter = 0
-    for read, complete_sequence in reads.items():
-        if counter % 10000 == 0:
-            print(str(counter) + ' of ' + str(len(reads)))
-        if len(complete_sequence) > 300:
-                sequence = complete_sequence[:300]
-
-                TSO_list, Nextera_list = [], []
-                max_dist1, Next_match = 4, ''
-                for Next in Nexts:
-                    hseq = Nexts[Next]
-                    length = len(hseq)
-                    temp_dists = []
-                    for i in range(len(sequence) - length):
-                        dist = ld.eval(hseq, sequence[i:i+length])
-                        temp_dists.append(dist)
-                    smallest_dist = sorted(temp_dists)[0]
-                    Nextera_list.append((Next, smallest_dist))
-
-                max_dist2, TSO_match = 4, ''
-                for TSO in TSOs:
-                    hseq = TSOs[TSO]
-                    length = len(hseq)
-                    temp_dists = []
-                    for i in range(len(sequence) - length):
-                        dist = ld.eval(hseq, sequence[i:i+length])
-                        temp_dists.append(dist)
-                    smallest_dist = sorted(temp_dists)[0]
-                    TSO_list.append((TSO, smallest_dist))
-
-                sorted_Nextera_list = sorted(Nextera_list, key=lambda x: x[1])
-                sorted_TSO_list = sorted(TSO_list, key=lambda x: x[1])
-                if sorted_Nextera_list[0][1] < max_dist1 and \
-                   sorted_Nextera_list[0][1] < sorted_Nextera_list[1][1]-1:
-                    Next_match = sorted_Nextera_list[0][0]
-                if sorted_TSO_list[0][1] < max_dist2 and \
-                   sorted_TSO_list[0][1] < sorted_TSO_list[1][1]-1:
-                    TSO_match = sorted_TSO_list[0][0]
-
-                read += '|' + Next_match + '_' + TSO_match
-                indexed_reads[read] = complete_sequence
-                counter += 1
+def pattern_masks(patterns):
+    '''Myers match masks: bit j of peq[c, p] is set if pattern p has base c at j'''
+    peq = np.zeros((5, len(patterns)), dtype=np.uint64)
+    for p, pattern in enumerate(patterns):
+        for j, base in enumerate(pattern):
+            peq[CODES[ord(base)], p] |= np.uint64(1 << j)
+    return peq
+
+def min_distances(texts, peq, lengths):
+    '''
+    Bit-parallel (Myers) approximate matching of every pattern against every text
+    at once. Returns the smallest edit distance of each pattern to any substring
+    of each text, shape (texts, patterns).
+    '''
+    batch = texts.shape[0]
+    n_patterns = peq.shape[1]
+    high = (np.uint64(1) << (lengths - 1).astype(np.uint64))
+    pv = np.broadcast_to((np.uint64(1) << lengths.astype(np.uint64)) - np.uint64(1),
+                         (batch, n_patterns)).copy()
+    mv = np.zeros((batch, n_patterns), dtype=np.uint64)
+    score = np.broadcast_to(lengths.astype(np.int64), (batch, n_patterns)).copy()
+    best = score.copy()
+    for j in range(texts.shape[1]):
+        eq = peq[texts[:, j]]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        score += (ph & high) != 0
+        score -= (mh & high) != 0
+        np.minimum(best, score, out=best)
+        # no carry into the first row: a match can start anywhere in the text
+        ph <<= np.uint64(1)
+        mh <<= np.uint64(1)
+        pv = mh | ~(xv | ph)
+        mv = ph & xv
+    return best
+
+def window_distance(hseq, sequence):
+    '''Original score: smallest edit distance over windows of the index length'''
+    length = len(hseq)
+    return min(ld.eval(hseq, sequence[i:i+length]) for i in range(len(sequence) - length))
+
+def pick_index(names, patterns, lower_bounds, sequence):
+    '''
+    Best index if it is closer than MAX_DIST and at least 2 better than the
+    runner-up. Windowed distances are only computed where the bit-parallel
+    lower bound says they could matter, anything else is already too far.
+    '''
+    dist_list = []
+    for name, hseq, bound in zip(names, patterns, lower_bounds):
+        if bound <= MAX_DIST:
+            dist_list.append((name, window_distance(hseq, sequence)))
+    dist_list = sorted(dist_list, key=lambda x: x[1])
+    if not dist_list or dist_list[0][1] >= MAX_DIST:
+        return ''
+    if len(dist_list) > 1 and dist_list[0][1] >= dist_list[1][1] - 1:
+        return ''
+    return dist_list[0][0]
+
+def init_worker(nexts, tsos):
+    global NEXTS, TSOS, PEQ, LENGTHS
+    NEXTS, TSOS = nexts, tsos
+    patterns = list(nexts.values()) + list(tsos.values())
+    PEQ = pattern_masks(patterns)
+    LENGTHS = np.array([len(x) for x in patterns], dtype=np.int64)
+
+def demultiplex(batch):
+    reads = [(read, seq) for read, seq in batch if len(seq) > SEARCH_LEN]
+    if not reads:
+        return []
+    # windows start before SEARCH_LEN - index length, so they all fit in this text
+    texts = np.array([np.frombuffer(seq[:SEARCH_LEN - 1].encode(), dtype=np.uint8) for _, seq in reads])
+    bounds = min_distances(CODES[texts], PEQ, LENGTHS)
+    n_next = len(NEXTS)
+    indexed_reads = []
+    for (read, complete_sequence), read_bounds in zip(reads, bounds):
+        sequence = complete_sequence[:SEARCH_LEN]
+        Next_match = pick_index(list(NEXTS), list(NEXTS.values()), read_bounds[:n_next], sequence)
+        TSO_match = pick_index(list(TSOS), list(TSOS.values()), read_bounds[n_next:], sequence)
+        indexed_reads.append((read + '|' + Next_match + '_' + TSO_match, complete_sequence))
     return indexed_reads
 
-def write_fasta_file(path, reads):
-    out = open(path + '/Indexed_reads.fasta', 'w')
-    for name, sequence in reads.items():
-        out.write('>%s\n%s\n' %(name, sequence))
+def batches(inFile, batch_size):
+    batch = []
+    for read in stream_fasta(inFile):
+        batch.append(read)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def main():
-    reads = read_fasta(input_file)
-    indexed_reads = demultiplex(reads, nextera_file, tso_file)
-    write_fasta_file(output_path, indexed_reads)
+    args = parser.parse_args()
+    output_path = args.output_path + '/'
+    Nexts = read_fasta(args.nextera_index_file)
+    TSOs = read_fasta(args.tso_index_file)
+
+    out = open(output_path + '/Indexed_reads.fasta', 'w')
+    counter = 0
+    pool = mp.Pool(args.threads, initializer=init_worker, initargs=(Nexts, TSOs))
+
+    def write_batch(result):
+        nonlocal counter
+        indexed_reads = result.get()
+        for name, sequence in indexed_reads:
+            out.write('>%s\n%s\n' %(name, sequence))
+        counter += len(indexed_reads)
+        print(str(counter) + ' reads demultiplexed')
+
+    # a few batches per process in flight keeps memory flat, writing them
+    # in submission order keeps the input order
+    in_flight = deque()
+    for batch in batches(args.input_fasta_file, args.batch_size):
+        in_flight.append(pool.apply_async(demultiplex, (batch,)))
+        if len(in_flight) >= 2 * args.threads:
+            write_batch(in_flight.popleft())
+    while in_flight:
+        write_batch(in_flight.popleft())
+    pool.close()
+    pool.join()
+    out.close()
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import errno
+import tempfile
+import unittest
+from unittest import mock
+
+PATH = '/'.join(os.path.realpath(__file__).split('/')[:-2]) + '/bin/'
+sys.path.append(os.path.abspath(PATH))
+
+import concat
+
+def failing_after(copy, calls):
+    '''Wraps os.copy_file_range or os.sendfile to fail once it was called calls times'''
+    made = []
+    def wrapped(*args):
+        if len(made) == calls:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        made.append(args)
+        return copy(*args)
+    return wrapped
+
+class AppendFileTest(unittest.TestCase):
+    '''append_file has to resume where a kernel copy that failed partway stopped'''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(10000)
+        self.path = self.tmp.name + '/part'
+        with open(self.path, 'wb') as fh:
+            fh.write(self.data)
+        self.output = self.tmp.name + '/merged'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def append_twice(self):
+        '''Appends the part after a header, twice, and returns the merged bytes'''
+        with open(self.output, 'wb+', buffering=0) as dst:
+            dst.write(b'header\n')
+            for _ in range(2):
+                concat.append_file(self.path, dst)
+        with open(self.output, 'rb') as fh:
+            return fh.read()
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range') and hasattr(os, 'sendfile'),
+                         'needs copy_file_range and sendfile')
+    def test_copy_file_range_fails_partway(self):
+        with mock.patch.object(concat, 'CHUNK', 3000), \
+             mock.patch.object(os, 'copy_file_range', failing_after(os.copy_file_range, 2)):
+            merged = self.append_twice()
+        self.assertEqual(merged, b'header\n' + self.data + self.data)
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range') and hasattr(os, 'sendfile'),
+                         'needs copy_file_range and sendfile')
+    def test_every_kernel_copy_fails_partway(self):
+        with mock.patch.object(concat, 'CHUNK', 3000), \
+             mock.patch.object(os, 'copy_file_range', failing_after(os.copy_file_range, 1)), \
+             mock.patch.object(os, 'sendfile', failing_after(os.sendfile, 1)):
+            merged = self.append_twice()
+        self.assertEqual(merged, b'header\n' + self.data + self.data)
+
+if __name__ == '__main__':
+    unittest.main()
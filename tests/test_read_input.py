@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import tempfile
+import unittest
+from unittest import mock
+
+PATH = '/'.join(os.path.realpath(__file__).split('/')[:-2]) + '/bin/'
+sys.path.append(os.path.abspath(PATH))
+
+import read_input
+from read_input import iter_reads, CHUNK_READS
+
+def dying_reader(path, chunks):
+    '''A reader process that exits without sending anything'''
+    os._exit(1)
+
+class IterReadsTest(unittest.TestCase):
+    '''Reader processes have to give the reads of every file in order, chunk by chunk'''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files, self.reads = [], []
+        # files over a chunk, under a chunk and gzipped
+        for i, count in enumerate([CHUNK_READS + 10, 25, 2 * CHUNK_READS + 1]):
+            path = self.tmp.name + '/part' + str(i) + ('.fastq.gz' if i == 2 else '.fastq')
+            fh = gzip.open(path, 'wt') if i == 2 else open(path, 'w')
+            for j in range(count):
+                read = ('read' + str(i) + '_' + str(j), 'ACGT' * (j % 5 + 1), 'I' * 4 * (j % 5 + 1))
+                print('@' + read[0], read[1], '+', read[2], sep='\n', file=fh)
+                self.reads.append(read)
+            fh.close()
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_order(self):
+        for procs in [1, 2, 3]:
+            self.assertEqual(list(iter_reads(self.files, procs)), self.reads)
+
+    def test_stop_early(self):
+        reads = iter_reads(self.files, 2)
+        first = [next(reads) for _ in range(10)]
+        reads.close()
+        self.assertEqual(first, self.reads[:10])
+
+    def test_reader_dies(self):
+        with mock.patch.object(read_input, 'read_chunks', dying_reader):
+            with self.assertRaises(RuntimeError):
+                list(iter_reads(self.files, 2))
+
+if __name__ == '__main__':
+    unittest.main()